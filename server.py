@@ -1,10 +1,64 @@
 from mcp.server.fastmcp import FastMCP, Context
+import asyncio
+import atexit
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import fnmatch
+import hashlib
+import heapq
+import json
+import logging
+import logging.handlers
+import queue
+import random
 import subprocess
 import os
 import pathlib
+import re
+import select
+import shutil
+import signal
+import struct
 import sys
+import threading
 import time
-from typing import Optional, List, Dict, Any, Literal, Union
+from stat import S_ISDIR, S_ISREG
+from dataclasses import asdict, dataclass, field, replace
+from typing import Optional, List, Dict, Any, Literal, Tuple, Union
+
+# Logging: records go through a queue and are written to stderr by a listener thread, so
+# the event loop never blocks on the stderr pipe. VIBE_TOOLS_LOG_LEVEL sets verbosity.
+logger = logging.getLogger("mcp_vibe_tools")
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, str(default)))
+    except ValueError:
+        return default
+
+# Child stderr is logged for the first LOG_SAMPLE_FIRST lines, then one in every LOG_SAMPLE_EVERY
+LOG_SAMPLE_FIRST = _env_int('VIBE_TOOLS_LOG_SAMPLE_FIRST', 20)
+LOG_SAMPLE_EVERY = max(1, _env_int('VIBE_TOOLS_LOG_SAMPLE_EVERY', 100))
+
+def _configure_logging() -> Optional[logging.handlers.QueueListener]:
+    """Attach a queue handler to the server logger and start the draining thread."""
+    level_name = os.environ.get('VIBE_TOOLS_LOG_LEVEL', 'WARNING').upper()
+    logger.setLevel(getattr(logging, level_name, logging.WARNING))
+    logger.propagate = False
+    if logger.handlers:
+        return None
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    return listener
+
+_log_listener = _configure_logging()
 
 # Read version from pyproject.toml
 VERSION = "0.0.0"  # Default version
@@ -15,9 +69,9 @@ try:
                 VERSION = line.split("=")[1].strip().strip('"')
                 break
 except FileNotFoundError:
-    print("DEBUG: pyproject.toml not found, using default version.", file=sys.stderr)
+    logger.debug("pyproject.toml not found, using default version.")
 except Exception as e:
-    print(f"DEBUG: Error reading version from pyproject.toml: {e}", file=sys.stderr)
+    logger.warning("Error reading version from pyproject.toml: %s", e)
 
 # Get cursor-tools path from environment or use default
 vibe_tools_path = os.environ.get('VIBE_TOOLS_PATH')
@@ -28,9 +82,9 @@ elif cursor_tools_path:
     cursor_tools_exec = cursor_tools_path
 else:
     cursor_tools_exec = 'cursor-tools'
-print(f"DEBUG: VIBE_TOOLS_PATH from env: {vibe_tools_path}", file=sys.stderr)
-print(f"DEBUG: CURSOR_TOOLS_PATH from env: {cursor_tools_path}", file=sys.stderr)
-print(f"DEBUG: Using cursor-tools executable: {cursor_tools_exec}", file=sys.stderr)
+logger.debug("VIBE_TOOLS_PATH from env: %s", vibe_tools_path)
+logger.debug("CURSOR_TOOLS_PATH from env: %s", cursor_tools_path)
+logger.debug("Using cursor-tools executable: %s", cursor_tools_exec)
 
 # Initialize FastMCP
 mcp = FastMCP(
@@ -87,151 +141,950 @@ def build_command_args(
     
     return command_args
 
-async def run_cursor_tools(
+@dataclass
+class CommandResult:
+    """Outcome of a single cursor-tools invocation."""
+    returncode: Optional[int]
+    stdout: str = ""
+    stderr: str = ""
+    error: Optional[str] = None
+    duration: float = 0.0
+    # Seconds from spawn until the child wrote anything, None if it never did
+    time_to_first_byte: Optional[float] = None
+    stdout_bytes: int = 0
+    stderr_bytes: int = 0
+    # "hit", "stale", "similar" or "miss" for cached tools, None otherwise
+    cache: Optional[str] = None
+    # Bytes produced by the child but not retained because of VIBE_TOOLS_MAX_OUTPUT_BYTES
+    truncated_bytes: int = 0
+    # Ran far past its historical p99
+    stalled: bool = False
+    # Child resource usage from wait4, None where unavailable
+    cpu_user_seconds: Optional[float] = None
+    cpu_system_seconds: Optional[float] = None
+    max_rss_kb: Optional[int] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.returncode == 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Structured response for clients that prefer fields over text."""
+        return {
+            "ok": self.ok,
+            "exit_code": self.returncode,
+            "stdout": self.stdout,
+            "stderr": self.stderr,
+            "error": self.error,
+            "duration_seconds": round(self.duration, 3),
+            "time_to_first_byte_seconds": None if self.time_to_first_byte is None else round(self.time_to_first_byte, 3),
+            "stdout_bytes": self.stdout_bytes,
+            "stderr_bytes": self.stderr_bytes,
+            "cache": self.cache,
+            "truncated": self.truncated_bytes > 0,
+            "truncated_bytes": self.truncated_bytes,
+            "stalled": self.stalled,
+            "cpu_user_seconds": self.cpu_user_seconds,
+            "cpu_system_seconds": self.cpu_system_seconds,
+            "max_rss_kb": self.max_rss_kb
+        }
+
+def format_result(result: CommandResult) -> str:
+    """Render a CommandResult as the text response returned by the tools."""
+    if result.error is not None:
+        return result.error
+    if result.returncode == 0:
+        return f"Command successful:\n{result.stdout}"
+    return f"Command failed with code {result.returncode}:\nStdout:\n{result.stdout}\nStderr:\n{result.stderr}"
+
+# Tools return text by default; VIBE_TOOLS_STRUCTURED_RESULTS=1 (or structured=True per call)
+# returns CommandResult.to_dict() instead
+structured_results_default = os.environ.get('VIBE_TOOLS_STRUCTURED_RESULTS', '').lower() in ('1', 'true', 'yes')
+
+def render_result(result: CommandResult, structured: Optional[bool] = None) -> Union[str, Dict[str, Any]]:
+    """Return the tool response for result in the requested shape."""
+    if structured is None:
+        structured = structured_results_default
+    return result.to_dict() if structured else format_result(result)
+
+# Executable resolution and capability probe, run once at startup and cached on disk
+# keyed by the binary's mtime, so unsupported tools fail without spawning a process
+KNOWN_SUBCOMMANDS = ["ask", "plan", "web", "repo", "doc", "youtube", "github", "clickup", "mcp", "browser", "xcode"]
+PROBE_TIMEOUT_SECONDS = 15
+
+EXECUTABLE_NOT_FOUND_ERROR = "Error: cursor-tools executable not found. Set VIBE_TOOLS_PATH (preferred) or CURSOR_TOOLS_PATH environment variable to the absolute path of the vibe-tools executable."
+
+@dataclass
+class ExecutableProbe:
+    """What the installed vibe-tools binary is and what it supports."""
+    requested: str
+    path: Optional[str]
+    mtime_ns: int = 0
+    version: Optional[str] = None
+    # Empty when --help could not be parsed; nothing is rejected in that case
+    subcommands: List[str] = field(default_factory=list)
+    flags: List[str] = field(default_factory=list)
+
+    def check(self, command_args: List[str]) -> Optional[str]:
+        """Return an error message if command_args cannot run on this binary."""
+        if self.path is None:
+            return EXECUTABLE_NOT_FOUND_ERROR
+        if self.subcommands and len(command_args) > 1 and command_args[1] not in self.subcommands:
+            version = f" {self.version}" if self.version else ""
+            return f"Error: the installed vibe-tools{version} at {self.path} does not support the '{command_args[1]}' command."
+        return None
+
+_probe: Optional[ExecutableProbe] = None
+
+def _run_probe_command(path: str, flag: str) -> str:
+    try:
+        completed = subprocess.run(
+            [path, flag], capture_output=True, text=True, timeout=PROBE_TIMEOUT_SECONDS
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.warning("Probe '%s %s' failed: %s", path, flag, e)
+        return ""
+    return completed.stdout + completed.stderr
+
+def probe_executable(executable: str) -> ExecutableProbe:
+    """Resolve executable through PATH and record its version, subcommands and flags.
+    
+    Results are cached in the cache directory and reused while the binary's mtime is unchanged.
+    Blocking: call at startup or from a worker thread.
+    """
+    path = shutil.which(executable)
+    if path is None:
+        return ExecutableProbe(requested=executable, path=None)
+    path = os.path.abspath(path)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return ExecutableProbe(requested=executable, path=None)
+    
+    cache_path = _cache_dir() / "probe.json"
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cached = cache.get(path)
+    if cached and cached.get("mtime_ns") == mtime_ns:
+        return ExecutableProbe(**dict(cached, requested=executable))
+    
+    version_output = _run_probe_command(path, "--version").strip()
+    help_text = _run_probe_command(path, "--help")
+    probe = ExecutableProbe(
+        requested=executable,
+        path=path,
+        mtime_ns=mtime_ns,
+        version=version_output.splitlines()[0] if version_output else None,
+        subcommands=[name for name in KNOWN_SUBCOMMANDS if re.search(rf"\b{name}\b", help_text)],
+        flags=sorted(set(re.findall(r"--[A-Za-z][\w-]*", help_text)))
+    )
+    cache[path] = asdict(probe)
+    del cache[path]["requested"]
+    try:
+        tmp_path = cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.warning("Could not write probe cache: %s", e)
+    return probe
+
+async def _resolve_command(command_args: List[str]) -> Tuple[List[str], Optional[str]]:
+    """Swap in the probed absolute path, re-probing if the binary changed on disk.
+    
+    Returns the command to run and an error message when the probe rules it out.
+    """
+    global _probe
+    probe = _probe
+    if probe is None or not command_args or command_args[0] != probe.requested:
+        return command_args, None
+    if probe.path is not None:
+        try:
+            current_mtime = os.stat(probe.path).st_mtime_ns
+        except OSError:
+            current_mtime = None
+        if current_mtime != probe.mtime_ns:
+            probe = _probe = await asyncio.to_thread(probe_executable, probe.requested)
+    error = probe.check(command_args)
+    if error:
+        return command_args, error
+    return [probe.path] + command_args[1:], None
+
+# Per-stream cap on retained child output; 0 keeps everything
+try:
+    MAX_OUTPUT_BYTES = int(os.environ.get('VIBE_TOOLS_MAX_OUTPUT_BYTES', '0'))
+except ValueError:
+    MAX_OUTPUT_BYTES = 0
+
+# Duration statistics per (subcommand, provider), persisted in the cache directory and used
+# to turn elapsed time and output volume into progress, ETA and stall detection
+DURATION_EWMA_ALPHA = 0.2
+DURATION_SAMPLE_LIMIT = 200
+# Below this many completed runs progress falls back to the elapsed-time heuristic
+DURATION_MIN_SAMPLES = 3
+# A run is flagged as a likely stall once it exceeds p99 by this factor
+STALL_FACTOR = 1.5
+
+@dataclass
+class DurationStats:
+    """Completed-run history for one subcommand/provider pair."""
+    count: int = 0
+    ewma_duration: float = 0.0
+    ewma_output_bytes: float = 0.0
+    # Most recent durations, oldest first
+    samples: List[float] = field(default_factory=list)
+
+    def record(self, duration: float, output_bytes: int) -> None:
+        if self.count == 0:
+            self.ewma_duration = duration
+            self.ewma_output_bytes = float(output_bytes)
+        else:
+            self.ewma_duration += DURATION_EWMA_ALPHA * (duration - self.ewma_duration)
+            self.ewma_output_bytes += DURATION_EWMA_ALPHA * (output_bytes - self.ewma_output_bytes)
+        self.count += 1
+        self.samples.append(duration)
+        del self.samples[:-DURATION_SAMPLE_LIMIT]
+
+    def quantile(self, q: float) -> float:
+        """Linear-interpolated quantile of the recent durations."""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        position = q * (len(ordered) - 1)
+        lower = int(position)
+        upper = min(lower + 1, len(ordered) - 1)
+        return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+@dataclass
+class ProgressEstimate:
+    percent: int
+    eta_seconds: Optional[float]
+    stalled: bool
+
+_duration_stats: Optional[Dict[str, DurationStats]] = None
+_duration_stats_lock = threading.Lock()
+
+# Subcommands whose second word selects the actual operation
+TWO_WORD_SUBCOMMANDS = {"github", "clickup", "mcp", "browser", "xcode"}
+
+def duration_stats_key(command_args: List[str]) -> str:
+    """Key such as "repo|gemini" or "github pr|default" for a command line."""
+    words = command_args[1:3] if len(command_args) > 2 and command_args[1] in TWO_WORD_SUBCOMMANDS else command_args[1:2]
+    provider = "default"
+    for arg in command_args:
+        if arg.startswith("--provider="):
+            provider = arg.split("=", 1)[1].strip('"')
+    return f"{' '.join(words)}|{provider}"
+
+def _duration_stats_path() -> pathlib.Path:
+    return _cache_dir() / "duration_stats.json"
+
+def get_duration_stats() -> Dict[str, DurationStats]:
+    """Load the persisted statistics on first use."""
+    global _duration_stats
+    if _duration_stats is None:
+        try:
+            with open(_duration_stats_path(), "r") as f:
+                raw = json.load(f)
+            _duration_stats = {key: DurationStats(**value) for key, value in raw.items()}
+        except (OSError, ValueError, TypeError):
+            _duration_stats = {}
+    return _duration_stats
+
+def save_duration_stats() -> None:
+    """Persist the statistics atomically. Blocking: call from a worker thread."""
+    with _duration_stats_lock:
+        snapshot = {key: asdict(stats) for key, stats in get_duration_stats().items()}
+        path = _duration_stats_path()
+        tmp_path = path.with_suffix(".tmp")
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not save duration statistics: %s", e)
+
+def estimate_progress(stats: Optional[DurationStats], elapsed: float, output_bytes: int) -> ProgressEstimate:
+    """Estimate completion from run history, falling back to the elapsed-time heuristic."""
+    if stats is None or stats.count < DURATION_MIN_SAMPLES or stats.ewma_duration <= 0:
+        return ProgressEstimate(percent=min(int(elapsed / 3), 95), eta_seconds=None, stalled=False)
+    fraction = elapsed / stats.ewma_duration
+    if stats.ewma_output_bytes > 0:
+        # Output usually arrives late, so it can only pull the estimate forward
+        fraction = max(fraction, output_bytes / stats.ewma_output_bytes)
+    expected = max(stats.ewma_duration, stats.quantile(0.5))
+    if elapsed > expected:
+        # Past the typical duration, aim for the tail instead of reporting zero
+        expected = stats.quantile(0.99)
+    return ProgressEstimate(
+        percent=min(int(fraction * 100), 95),
+        eta_seconds=max(expected - elapsed, 0.0),
+        stalled=elapsed > stats.quantile(0.99) * STALL_FACTOR
+    )
+
+# Resource limits for spawned children (rlimits set with prlimit as soon as Popen returns)
+# and per-call accounting from wait4. Limits are off unless configured. A preexec_fn would
+# close the small window before the limits apply, but it is unsafe with threads running, and
+# this server always has some (log listener, stream readers, watcher, to_thread workers).
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+@dataclass
+class ResourceLimits:
+    """Per-child rlimits; None leaves the inherited limit in place."""
+    # RLIMIT_AS in MiB. Node reserves a lot of address space up front, so keep this generous.
+    max_memory_mb: Optional[int] = None
+    # RLIMIT_CPU in seconds of CPU time (the child gets SIGXCPU, then SIGKILL)
+    max_cpu_seconds: Optional[int] = None
+    # RLIMIT_NOFILE
+    max_open_files: Optional[int] = None
+
+    @property
+    def active(self) -> bool:
+        return any(value is not None for value in (self.max_memory_mb, self.max_cpu_seconds, self.max_open_files))
+
+    def apply(self, pid: int) -> None:
+        """Lower the soft limits of a running process (raises OSError if it is gone)."""
+        for limit, value in (
+            (resource.RLIMIT_AS, self.max_memory_mb * 1024 * 1024 if self.max_memory_mb else None),
+            (resource.RLIMIT_CPU, self.max_cpu_seconds),
+            (resource.RLIMIT_NOFILE, self.max_open_files)
+        ):
+            if value is None:
+                continue
+            _, hard = resource.prlimit(pid, limit)
+            if hard != resource.RLIM_INFINITY:
+                value = min(value, hard)
+            resource.prlimit(pid, limit, (value, hard))
+
+def _optional_env_int(name: str) -> Optional[int]:
+    value = _env_int(name, 0)
+    return value if value > 0 else None
+
+child_limits = ResourceLimits(
+    max_memory_mb=_optional_env_int('VIBE_TOOLS_CHILD_MAX_MEMORY_MB'),
+    max_cpu_seconds=_optional_env_int('VIBE_TOOLS_CHILD_MAX_CPU_SECONDS'),
+    max_open_files=_optional_env_int('VIBE_TOOLS_CHILD_MAX_OPEN_FILES')
+)
+# prlimit is Linux only
+prlimit_supported = resource is not None and hasattr(resource, "prlimit")
+if child_limits.active and not prlimit_supported:
+    logger.warning("Child resource limits are configured but need prlimit (Linux); they will not be applied")
+
+def _reap_child(process: subprocess.Popen) -> Tuple[int, Optional[Any]]:
+    """Wait for process, returning its exit code and rusage where wait4 is available."""
+    if not hasattr(os, "wait4"):
+        return process.wait(), None
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        # Already reaped elsewhere
+        return process.wait(), None
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage
+
+@dataclass
+class CommandMetrics:
+    """Running totals for one command (e.g. "repo" or "github pr")."""
+    calls: int = 0
+    failures: int = 0
+    total_duration: float = 0.0
+    cpu_user_seconds: float = 0.0
+    cpu_system_seconds: float = 0.0
+    max_rss_kb: int = 0
+    output_bytes: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "avg_duration_seconds": round(self.total_duration / self.calls, 3) if self.calls else 0.0,
+            "cpu_user_seconds": round(self.cpu_user_seconds, 3),
+            "cpu_system_seconds": round(self.cpu_system_seconds, 3),
+            "avg_cpu_seconds": round((self.cpu_user_seconds + self.cpu_system_seconds) / self.calls, 3) if self.calls else 0.0,
+            "max_rss_kb": self.max_rss_kb,
+            "output_bytes": self.output_bytes
+        }
+
+_command_metrics: Dict[str, CommandMetrics] = {}
+
+def record_command_metrics(command: str, result: "CommandResult") -> None:
+    metrics = _command_metrics.setdefault(command, CommandMetrics())
+    metrics.calls += 1
+    if not result.ok:
+        metrics.failures += 1
+    metrics.total_duration += result.duration
+    metrics.cpu_user_seconds += result.cpu_user_seconds or 0.0
+    metrics.cpu_system_seconds += result.cpu_system_seconds or 0.0
+    metrics.max_rss_kb = max(metrics.max_rss_kb, result.max_rss_kb or 0)
+    metrics.output_bytes += result.stdout_bytes + result.stderr_bytes
+
+# Append-only invocation log: one compact JSON line per spawned command, written by a
+# listener thread through a size-rotated file handler so the event loop never touches disk
+INVOCATION_LOG_MAX_BYTES = _env_int('VIBE_TOOLS_INVOCATION_LOG_MAX_BYTES', 10 * 1024 * 1024)
+INVOCATION_LOG_BACKUPS = _env_int('VIBE_TOOLS_INVOCATION_LOG_BACKUPS', 3)
+invocation_log_enabled = os.environ.get('VIBE_TOOLS_INVOCATION_LOG', '1').lower() not in ('0', 'false', 'no')
+# Samples kept per tool for the percentile estimates in invocation_stats
+INVOCATION_STATS_RESERVOIR = 1024
+
+_invocation_logger = logging.getLogger("mcp_vibe_tools.invocations")
+_invocation_logger.setLevel(logging.INFO)
+_invocation_logger.propagate = False
+# (log path, handler, listener) for the currently configured log file
+_invocation_log: Optional[Tuple[pathlib.Path, logging.Handler, logging.handlers.QueueListener]] = None
+_invocation_log_lock = threading.Lock()
+
+SECRET_FLAG_PATTERN = re.compile(r"^--?(?!-|max)[\w-]*(token|secret|password|passwd|api[-_]?key|auth(?!ors?(?![a-z]))|credential)[\w-]*$", re.IGNORECASE)
+SECRET_VALUE_PATTERN = re.compile(r"\b(sk-[\w-]{16,}|gh[pousr]_\w{20,}|github_pat_\w{20,}|xox[abpr]-[\w-]{10,}|AKIA[0-9A-Z]{16}|pk_\w{20,})")
+REDACTED = "[REDACTED]"
+
+def redact_argv(args: List[str]) -> List[str]:
+    """Mask values of secret-looking flags and anything shaped like a well-known API key."""
+    redacted = []
+    redact_next = False
+    for arg in args:
+        if redact_next:
+            redacted.append(REDACTED)
+            redact_next = False
+            continue
+        flag, sep, _ = arg.partition("=")
+        if SECRET_FLAG_PATTERN.match(flag):
+            if sep:
+                redacted.append(f"{flag}={REDACTED}")
+                continue
+            redact_next = True
+        redacted.append(SECRET_VALUE_PATTERN.sub(REDACTED, arg))
+    return redacted
+
+def invocation_log_path() -> pathlib.Path:
+    return _cache_dir_path() / "invocations.jsonl"
+
+def _invocation_log_handler() -> logging.Handler:
+    """Start (or retarget, if the cache directory moved) the invocation log writer.
+    
+    Runs on the event loop for every record, so it only touches the filesystem when the
+    writer is (re)opened.
+    """
+    global _invocation_log
+    path = invocation_log_path()
+    with _invocation_log_lock:
+        if _invocation_log is not None:
+            current_path, handler, listener = _invocation_log
+            if current_path == path:
+                return handler
+            _close_invocation_log()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=INVOCATION_LOG_MAX_BYTES, backupCount=INVOCATION_LOG_BACKUPS,
+            encoding="utf-8", delay=True
+        )
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        listener = logging.handlers.QueueListener(log_queue, file_handler)
+        listener.start()
+        handler = logging.handlers.QueueHandler(log_queue)
+        _invocation_logger.addHandler(handler)
+        _invocation_log = (path, handler, listener)
+        return handler
+
+def _close_invocation_log() -> None:
+    """Flush queued records and close the log file."""
+    global _invocation_log
+    if _invocation_log is None:
+        return
+    _, handler, listener = _invocation_log
+    _invocation_logger.removeHandler(handler)
+    listener.stop()
+    for file_handler in listener.handlers:
+        file_handler.close()
+    _invocation_log = None
+
+atexit.register(_close_invocation_log)
+
+def record_invocation(command_args: List[str], cwd: str, result: "CommandResult") -> None:
+    """Queue one invocation record for the log writer.
+    
+    Every child run is recorded by _execute_cursor_tools; the caches record the calls they
+    answer themselves, with result.cache set and the time it took to serve them.
+    """
+    if not invocation_log_enabled:
+        return
+    tool, _, provider = duration_stats_key(command_args).partition("|")
+    record = {
+        "ts": round(time.time(), 3),
+        "tool": tool,
+        "provider": provider,
+        "argv": redact_argv(command_args[1:]),
+        "cwd": cwd,
+        "duration": round(result.duration, 3),
+        "exit": result.returncode,
+        "bytes": result.stdout_bytes + result.stderr_bytes
+    }
+    if result.cache is not None:
+        # Answered without a child of its own
+        record["cache"] = result.cache
+    try:
+        _invocation_log_handler()
+    except OSError as e:
+        logger.warning("Cannot open invocation log: %s", e)
+        return
+    _invocation_logger.info("%s", json.dumps(record, separators=(",", ":")))
+
+def _invocation_log_files() -> List[pathlib.Path]:
+    """Rotated log files, oldest first."""
+    path = invocation_log_path()
+    backups = [path.with_name(f"{path.name}.{index}") for index in range(INVOCATION_LOG_BACKUPS, 0, -1)]
+    return [candidate for candidate in backups + [path] if candidate.exists()]
+
+def aggregate_invocations(tool: Optional[str] = None, since: Optional[float] = None, top: int = 10) -> Dict[str, Any]:
+    """Stream the invocation log once, keeping only bounded state. Blocking: call from a worker thread."""
+    slowest: List[Tuple[float, int, Dict[str, Any]]] = []
+    per_tool: Dict[str, Dict[str, Any]] = {}
+    per_provider: Dict[str, Dict[str, int]] = {}
+    sampler = random.Random(0)
+    total = 0
+    for path in _invocation_log_files():
+        try:
+            handle = open(path, "r", encoding="utf-8")
+        except OSError:
+            continue
+        with handle:
+            for line in handle:
+                try:
+                    record = json.loads(line)
+                    duration = float(record["duration"])
+                except (ValueError, KeyError, TypeError):
+                    # Torn or foreign line
+                    continue
+                if tool is not None and record.get("tool") != tool:
+                    continue
+                if since is not None and record.get("ts", 0) < since:
+                    continue
+                total += 1
+                failed = record.get("exit") != 0
+                
+                entry = (duration, total, record)
+                if len(slowest) < top:
+                    heapq.heappush(slowest, entry)
+                elif top and duration > slowest[0][0]:
+                    heapq.heapreplace(slowest, entry)
+                
+                stats = per_tool.setdefault(record.get("tool", ""), {"calls": 0, "errors": 0, "samples": []})
+                stats["calls"] += 1
+                stats["errors"] += failed
+                # Reservoir sampling keeps percentiles uniform over the whole history
+                if len(stats["samples"]) < INVOCATION_STATS_RESERVOIR:
+                    stats["samples"].append(duration)
+                else:
+                    slot = sampler.randrange(stats["calls"])
+                    if slot < INVOCATION_STATS_RESERVOIR:
+                        stats["samples"][slot] = duration
+                
+                provider = per_provider.setdefault(record.get("provider", "default"), {"calls": 0, "errors": 0})
+                provider["calls"] += 1
+                provider["errors"] += failed
+    
+    def percentiles(samples: List[float]) -> Dict[str, float]:
+        stats = DurationStats(samples=samples)
+        return {"p50": round(stats.quantile(0.5), 3), "p95": round(stats.quantile(0.95), 3)}
+    
+    return {
+        "invocations": total,
+        "slowest": [
+            {key: record.get(key) for key in ("ts", "tool", "provider", "argv", "cwd", "duration", "exit", "cache")}
+            for _, _, record in sorted(slowest, reverse=True)
+        ],
+        "tools": {
+            name: {"calls": stats["calls"], "error_rate": round(stats["errors"] / stats["calls"], 3), **percentiles(stats["samples"])}
+            for name, stats in sorted(per_tool.items())
+        },
+        "providers": {
+            name: {"calls": counts["calls"], "errors": counts["errors"], "error_rate": round(counts["errors"] / counts["calls"], 3)}
+            for name, counts in sorted(per_provider.items())
+        }
+    }
+
+# Scheduler limiting how many cursor-tools processes run at once. Calls wait in one of
+# three lanes; interactive calls go first and have slots of their own, and waiting calls
+# are promoted one lane per PRIORITY_AGING_SECONDS so bulk work is never starved.
+try:
+    max_concurrency = max(1, int(os.environ.get('VIBE_TOOLS_MAX_CONCURRENCY', '4')))
+except ValueError:
+    max_concurrency = 4
+PRIORITY_LANES = ("interactive", "normal", "bulk")
+# Slots only the interactive lane may use; at least one slot is always left for the others
+INTERACTIVE_RESERVED_SLOTS = _env_int('VIBE_TOOLS_INTERACTIVE_RESERVED', 1)
+try:
+    PRIORITY_AGING_SECONDS = float(os.environ.get('VIBE_TOOLS_PRIORITY_AGING_SECONDS', '30'))
+except ValueError:
+    PRIORITY_AGING_SECONDS = 30.0
+
+# Default lane per command (duration_stats_key names); anything else is normal
+COMMAND_LANES = {
+    "ask": "interactive",
+    "github pr": "interactive",
+    "github issue": "interactive",
+    "clickup task": "interactive",
+    "mcp search": "interactive",
+    "doc": "bulk",
+    "youtube": "bulk",
+    "xcode build": "bulk",
+}
+
+def default_lane(command_args: List[str]) -> str:
+    """Lane for a command line: per-command defaults, with remote repo analysis as bulk."""
+    command = duration_stats_key(command_args).split("|")[0]
+    if command == "repo" and "--from-github" in command_args:
+        return "bulk"
+    return COMMAND_LANES.get(command, "normal")
+
+@dataclass
+class LaneStats:
+    """Queue-wait totals for one lane."""
+    started: int = 0
+    waiting: int = 0
+    running: int = 0
+    total_wait: float = 0.0
+    max_wait: float = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "started": self.started,
+            "waiting": self.waiting,
+            "running": self.running,
+            "avg_wait_seconds": round(self.total_wait / self.started, 3) if self.started else 0.0,
+            "max_wait_seconds": round(self.max_wait, 3)
+        }
+
+@dataclass
+class _Waiter:
+    lane: str
+    enqueued: float
+    future: asyncio.Future
+
+class PriorityScheduler:
+    """Concurrency limit with interactive/normal/bulk lanes, reserved interactive slots and aging."""
+
+    def __init__(self, capacity: int, reserved: int, aging_seconds: float):
+        self.capacity = capacity
+        # Never reserve every slot, or normal and bulk work could not run at all
+        self.reserved = max(0, min(reserved, capacity - 1))
+        self.aging_seconds = aging_seconds
+        self.running = 0
+        self.lanes = {lane: LaneStats() for lane in PRIORITY_LANES}
+        self._waiters: List[_Waiter] = []
+
+    def _rank(self, waiter: _Waiter, now: float) -> int:
+        rank = PRIORITY_LANES.index(waiter.lane)
+        if self.aging_seconds > 0:
+            rank -= int((now - waiter.enqueued) / self.aging_seconds)
+        return max(0, rank)
+
+    def _can_start(self, lane: str) -> bool:
+        if self.running >= self.capacity:
+            return False
+        if lane == "interactive":
+            return True
+        return self.running - self.lanes["interactive"].running < self.capacity - self.reserved
+
+    def _dispatch(self) -> None:
+        """Start waiters in rank order while slots are free."""
+        now = time.monotonic()
+        # Stable sort keeps arrival order within a rank
+        for waiter in sorted(self._waiters, key=lambda waiter: (self._rank(waiter, now), waiter.enqueued)):
+            if self.running >= self.capacity:
+                break
+            if waiter.future.done() or not self._can_start(waiter.lane):
+                # Blocked only by the interactive reservation; later interactive waiters may still start
+                continue
+            self._waiters.remove(waiter)
+            self._start(waiter.lane, now - waiter.enqueued)
+            waiter.future.set_result(None)
+
+    def _start(self, lane: str, waited: float) -> None:
+        stats = self.lanes[lane]
+        self.running += 1
+        stats.running += 1
+        stats.started += 1
+        stats.total_wait += waited
+        stats.max_wait = max(stats.max_wait, waited)
+
+    def _release(self, lane: str) -> None:
+        self.running -= 1
+        self.lanes[lane].running -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, lane: str):
+        """Hold a slot in lane for the duration of the block."""
+        waiter = _Waiter(lane, time.monotonic(), asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self.lanes[lane].waiting += 1
+        # Starts the call at once when its lane has a free slot, even if other lanes are queued
+        self._dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted just before the cancellation arrived
+                self._release(lane)
+            else:
+                self._waiters.remove(waiter)
+            raise
+        finally:
+            self.lanes[lane].waiting -= 1
+        try:
+            yield
+        finally:
+            self._release(lane)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.capacity,
+            "interactive_reserved": self.reserved,
+            "running": self.running,
+            "lanes": {lane: stats.to_dict() for lane, stats in self.lanes.items()}
+        }
+
+_scheduler = PriorityScheduler(max_concurrency, INTERACTIVE_RESERVED_SLOTS, PRIORITY_AGING_SECONDS)
+
+# Seconds a terminated child gets to exit before it is killed
+CHILD_TERMINATE_GRACE_SECONDS = 5
+
+def _reap_terminated_child(process: subprocess.Popen) -> None:
+    """Wait for a terminated child, killing it if it ignores SIGTERM. Blocking: runs in a worker thread."""
+    try:
+        process.wait(timeout=CHILD_TERMINATE_GRACE_SECONDS)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def _pump_stream(stream, name: str, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue) -> None:
+    """Forward lines from a child pipe to the event loop (runs in a reader thread)."""
+    try:
+        for line in stream:
+            loop.call_soon_threadsafe(queue.put_nowait, (name, line))
+    except (ValueError, OSError):
+        pass
+    finally:
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, (name, None))
+        except RuntimeError:
+            # Event loop already closed
+            pass
+
+async def _execute_cursor_tools(
     command_args: List[str],
     ctx: Optional[Context] = None,
-    from_github: bool = False
-) -> str:
-    """Run the cursor-tools command and format the response."""
+    from_github: bool = False,
+    env: Optional[Dict[str, str]] = None,
+    limits: Optional[ResourceLimits] = None,
+    priority: Optional[str] = None,
+    execution_dir: Optional[str] = None
+) -> CommandResult:
+    """Run the cursor-tools command and log the outcome, including calls rejected before a child starts."""
     # Determine the execution directory
-    execution_dir = current_working_directory
-    if from_github:
-        execution_dir = os.getcwd()
+    if execution_dir is None:
+        execution_dir = os.getcwd() if from_github else current_working_directory
+    result = await _run_child(command_args, ctx, env, limits, priority, execution_dir)
+    record_invocation(command_args, execution_dir, result)
+    return result
+
+async def _run_child(
+    command_args: List[str],
+    ctx: Optional[Context],
+    env: Optional[Dict[str, str]],
+    limits: Optional[ResourceLimits],
+    priority: Optional[str],
+    execution_dir: str
+) -> CommandResult:
+    """Run the cursor-tools command through the scheduler without blocking the event loop.
+    
+    The call waits in the priority lane (default_lane for the command unless given). The
+    child runs under limits (child_limits by default) and its CPU time and peak RSS are
+    recorded in the result and in the per-command metrics.
+    """
+    if priority is None:
+        priority = default_lane(command_args)
+    elif priority not in PRIORITY_LANES:
+        return CommandResult(
+            returncode=None,
+            error=f"Error: unknown priority '{priority}'; use one of {', '.join(PRIORITY_LANES)}."
+        )
+    if limits is None:
+        limits = child_limits
     
-    try:
-        # Log command execution
+    command_args, probe_error = await _resolve_command(command_args)
+    if probe_error:
         if ctx:
-            await ctx.info(f"Executing command: {' '.join(command_args)}")
-            await ctx.info(f"Working directory: {execution_dir}")
-        
-        # Debug info
-        print(f"DEBUG: Running command: {' '.join(command_args)}", file=sys.stderr)
-        print(f"DEBUG: Working directory: {execution_dir}", file=sys.stderr)
+            await ctx.error(probe_error)
+        return CommandResult(returncode=None, error=probe_error)
+    
+    stats_key = duration_stats_key(command_args)
+    stats = get_duration_stats().get(stats_key)
+    
+    async with _scheduler.slot(priority):
+        try:
+            # Log command execution
+            if ctx:
+                await ctx.info(f"Executing command: {' '.join(command_args)}")
+                await ctx.info(f"Working directory: {execution_dir}")
+            
+            # Debug info
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Running command: %s", " ".join(command_args))
+                logger.debug("Working directory: %s", execution_dir)
+            
+            start_time = time.time()
+            
+            # Report starting progress
+            if ctx:
+                await ctx.report_progress(0, 100)
+            
+            # Run the command with realtime output processing
+            process = subprocess.Popen(
+                command_args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                cwd=execution_dir,
+                env=env
+            )
+        except FileNotFoundError as e:
+            # Specific handling for missing cursor-tools executable
+            if e.filename == command_args[0] or 'cursor-tools' in str(e):
+                error_msg = EXECUTABLE_NOT_FOUND_ERROR
+                if ctx:
+                    await ctx.error(error_msg)
+                return CommandResult(returncode=None, error=error_msg)
+            else:
+                # Re-raise other FileNotFoundError
+                raise
+        except Exception as e:
+            error_msg = f"Error executing command: {str(e)}"
+            if ctx:
+                await ctx.error(error_msg)
+            return CommandResult(returncode=None, error=error_msg)
         
-        start_time = time.time()
-        line_count = 0
+        if limits.active and prlimit_supported:
+            try:
+                limits.apply(process.pid)
+            except ProcessLookupError:
+                pass
+            except OSError as e:
+                logger.warning("Could not apply resource limits to pid %s: %s", process.pid, e)
         
-        # Report starting progress
-        if ctx:
-            await ctx.report_progress(0, 100)
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        for stream, name in ((process.stdout, "out"), (process.stderr, "err")):
+            threading.Thread(
+                target=_pump_stream, args=(stream, name, loop, queue), daemon=True
+            ).start()
         
-        # Run the command with realtime output processing
-        process = subprocess.Popen(
-            command_args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            cwd=execution_dir
-        )
-    except FileNotFoundError as e:
-        # Specific handling for missing cursor-tools executable
-        if 'cursor-tools' in str(e):
-            error_msg = "Error: cursor-tools executable not found. Set VIBE_TOOLS_PATH (preferred) or CURSOR_TOOLS_PATH environment variable to the absolute path of the vibe-tools executable."
-            if ctx:
-                await ctx.error(error_msg)
-            return error_msg
-        else:
-            # Re-raise other FileNotFoundError
-            raise
-    except Exception as e:
-        error_msg = f"Error executing command: {str(e)}"
-        if ctx:
-            await ctx.error(error_msg)
-        return error_msg
-    
-    stdout_lines = []
-    stderr_lines = []
-    
-    # Process output in real-time with progress updates
-    last_progress_time = time.time()
-    
-    try:
         stdout_lines = []
         stderr_lines = []
+        line_count = 0
+        stderr_line_count = 0
+        stderr_logged = 0
+        open_streams = 2
+        # Byte counts per stream: produced by the child, and retained in the result
+        produced = {"out": 0, "err": 0}
+        retained = {"out": 0, "err": 0}
+        overflowed = set()
+        first_byte_time = None
         
         # Process output in real-time with progress updates
         last_progress_time = time.time()
+        reported_pct = 0
+        stalled = False
         
-        while True:
-            # Read with timeout to ensure progress updates even without output
-            current_time = time.time()
-            elapsed = current_time - start_time
-            
-            # Send heartbeat progress updates every 3 seconds
-            if current_time - last_progress_time >= 3:
-                progress_pct = min(int(elapsed / 3), 95)  # Cap at 95% until complete
+        async def report_progress() -> ProgressEstimate:
+            nonlocal reported_pct, stalled
+            estimate = estimate_progress(stats, time.time() - start_time, produced["out"])
+            # Never move backwards, even when the estimate does
+            reported_pct = max(reported_pct, estimate.percent)
+            if ctx:
+                await ctx.report_progress(reported_pct, 100)
+            if estimate.stalled and not stalled:
+                stalled = True
+                message = (
+                    f"{stats_key.split('|')[0]} has run {time.time() - start_time:.0f}s, "
+                    f"far past its usual p99 of {stats.quantile(0.99):.0f}s; it is likely stalled"
+                )
+                logger.warning("%s", message)
                 if ctx:
-                    await ctx.report_progress(progress_pct, 100)
-                print(f"DEBUG: Progress heartbeat {progress_pct}%", file=sys.stderr)
-                last_progress_time = current_time
-            
-            # Check if process has terminated
-            if process.poll() is not None:
-                # Process remaining output
-                remaining_stdout, remaining_stderr = process.communicate()
-                if remaining_stdout:
-                    for line in remaining_stdout.splitlines():
-                        stdout_lines.append(line)
-                        if ctx:
-                            await ctx.info(f"OUT: {line}")
-                        line_count += 1
-                if remaining_stderr:
-                    for line in remaining_stderr.splitlines():
-                        stderr_lines.append(line)
-                        if ctx:
-                            await ctx.info(f"ERR: {line}")
-                        print(f"DEBUG: STDERR: {line}", file=sys.stderr)
-                        line_count += 1
-                break
+                    await ctx.warning(message)
+            return estimate
+        
+        try:
+            while open_streams:
+                # Wait for output, waking up for heartbeat progress updates every 3 seconds
+                timeout = max(0.0, 3 - (time.time() - last_progress_time))
+                try:
+                    name, raw_line = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    estimate = await report_progress()  # Capped at 95% until complete
+                    if estimate.eta_seconds is not None and ctx:
+                        await ctx.info(f"Progress {reported_pct}%, about {estimate.eta_seconds:.0f}s remaining")
+                    logger.debug("Progress heartbeat %d%%, ETA %s", reported_pct, estimate.eta_seconds)
+                    last_progress_time = time.time()
+                    continue
                 
-            # Read stdout with timeout
-            stdout_line = process.stdout.readline() if process.stdout else ""
-            stderr_line = process.stderr.readline() if process.stderr else ""
-            
-            if not stdout_line and not stderr_line:
-                # No data, sleep briefly and continue
-                time.sleep(0.1)
-                continue
+                if raw_line is None:
+                    open_streams -= 1
+                    continue
                 
-            if stdout_line:
-                line = stdout_line.rstrip()
-                stdout_lines.append(line)
-                if ctx:
-                    await ctx.info(f"OUT: {line}")
+                if first_byte_time is None:
+                    first_byte_time = time.time()
+                produced[name] += len(raw_line)
+                line = raw_line.decode("utf-8", errors="replace").rstrip()
                 line_count += 1
-                
-                # Update progress on each line
-                elapsed = time.time() - start_time
-                progress_pct = min(int(elapsed / 3), 95)
-                if ctx:
-                    await ctx.report_progress(progress_pct, 100)
-                last_progress_time = time.time()
-                
-            if stderr_line:
-                line = stderr_line.rstrip()
-                stderr_lines.append(line)
+                # Once a stream overflows, keep none of its later lines so the result has no gaps
+                keep = name not in overflowed and (
+                    not MAX_OUTPUT_BYTES or retained[name] + len(raw_line) <= MAX_OUTPUT_BYTES
+                )
+                if keep:
+                    retained[name] += len(raw_line)
+                else:
+                    overflowed.add(name)
+                if name == "out":
+                    if keep:
+                        stdout_lines.append(line)
+                    if ctx:
+                        await ctx.info(f"OUT: {line}")
+                    
+                    # Update progress on each line
+                    await report_progress()
+                    last_progress_time = time.time()
+                else:
+                    if keep:
+                        stderr_lines.append(line)
+                    if ctx:
+                        await ctx.info(f"ERR: {line}")
+                    # Sample chatty children: the first lines, then one in every LOG_SAMPLE_EVERY
+                    stderr_line_count += 1
+                    if stderr_line_count <= LOG_SAMPLE_FIRST or stderr_line_count % LOG_SAMPLE_EVERY == 0:
+                        stderr_logged += 1
+                        logger.debug("STDERR: %s", line)
+            
+            # Both pipes are closed; reap the child off the event loop
+            returncode, usage = await loop.run_in_executor(None, _reap_child, process)
+        except BaseException as e:
+            if not isinstance(e, asyncio.CancelledError):
+                logger.error("Exception in subprocess handling: %s", e)
                 if ctx:
-                    await ctx.info(f"ERR: {line}")
-                print(f"DEBUG: STDERR: {line}", file=sys.stderr)
-                line_count += 1
-    except Exception as e:
-        print(f"DEBUG: Exception in subprocess handling: {str(e)}", file=sys.stderr)
-        if ctx:
-            await ctx.error(f"Exception during command execution: {str(e)}")
-        # Try to terminate the process if still running
-        if process.poll() is None:
-            process.terminate()
-            try:
-                process.wait(timeout=5)
-            except subprocess.TimeoutExpired:
-                process.kill()
-        
-        # Re-raise to be caught by outer exception handler
-        raise
+                    await ctx.error(f"Exception during command execution: {str(e)}")
+            # Try to terminate the process if still running, reaping it off the event loop
+            if process.poll() is None:
+                process.terminate()
+                loop.run_in_executor(None, _reap_terminated_child, process)
+            
+            # Re-raise to be caught by outer exception handler
+            raise
     
-    # Get return code
-    returncode = process.poll()
-
     # Calculate execution time
     execution_time = time.time() - start_time
 
@@ -240,18 +1093,1188 @@ async def run_cursor_tools(
         await ctx.report_progress(100, 100)
     
     # Debug info
-    print(f"DEBUG: Command finished with code {returncode}", file=sys.stderr)
-    print(f"DEBUG: Execution time: {execution_time:.2f} seconds", file=sys.stderr)
-    print(f"DEBUG: Processed {line_count} lines of output", file=sys.stderr)
+    logger.debug(
+        "Command finished with code %s in %.2f seconds, %d lines of output (%d of %d stderr lines logged)",
+        returncode, execution_time, line_count, stderr_logged, stderr_line_count
+    )
+    
+    max_rss_kb = None
+    if usage is not None:
+        # ru_maxrss is in KiB on Linux and bytes on macOS
+        max_rss_kb = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+        if resource is not None and returncode == -getattr(signal, "SIGXCPU", 0):
+            logger.warning("%s hit the CPU time limit of %ss", stats_key.split("|")[0], limits.max_cpu_seconds)
+    
+    # Failed runs would skew the history of how long real work takes
+    if returncode == 0:
+        with _duration_stats_lock:
+            get_duration_stats().setdefault(stats_key, DurationStats()).record(execution_time, produced["out"])
+        asyncio.get_running_loop().run_in_executor(None, save_duration_stats)
+    
+    result = CommandResult(
+        returncode=returncode,
+        stdout="\n".join(stdout_lines),
+        stderr="\n".join(stderr_lines),
+        duration=execution_time,
+        time_to_first_byte=None if first_byte_time is None else first_byte_time - start_time,
+        stdout_bytes=produced["out"],
+        stderr_bytes=produced["err"],
+        truncated_bytes=sum(produced.values()) - sum(retained.values()),
+        stalled=stalled,
+        cpu_user_seconds=None if usage is None else usage.ru_utime,
+        cpu_system_seconds=None if usage is None else usage.ru_stime,
+        max_rss_kb=max_rss_kb
+    )
+    record_command_metrics(stats_key.split("|")[0], result)
+    return result
+
+async def run_cursor_tools(
+    command_args: List[str],
+    ctx: Optional[Context] = None,
+    from_github: bool = False,
+    env: Optional[Dict[str, str]] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None
+) -> Union[str, Dict[str, Any]]:
+    """Run the cursor-tools command and format the response."""
+    result = await _execute_cursor_tools(command_args, ctx, from_github, env, priority=priority)
+    return render_result(result, structured)
+
+# Stale-while-revalidate cache for remote lookups (github_pr, github_issue, clickup_task).
+# Entries younger than the soft TTL are served as-is; older ones are still served but
+# refreshed in the background; past the hard TTL the caller waits for a fresh fetch.
+try:
+    REMOTE_CACHE_SOFT_TTL = float(os.environ.get('VIBE_TOOLS_REMOTE_CACHE_TTL', '60'))
+    REMOTE_CACHE_HARD_TTL = float(os.environ.get('VIBE_TOOLS_REMOTE_CACHE_MAX_AGE', '600'))
+except ValueError:
+    REMOTE_CACHE_SOFT_TTL, REMOTE_CACHE_HARD_TTL = 60.0, 600.0
+
+@dataclass
+class RemoteCacheEntry:
+    result: CommandResult
+    fetched_at: float
+
+_remote_cache: Dict[Tuple, RemoteCacheEntry] = {}
+# In-flight fetches per key, shared by concurrent misses and background refreshes
+_remote_fetches: Dict[Tuple, asyncio.Task] = {}
+
+def _remote_fetch_done(task: asyncio.Task) -> None:
+    # Background revalidations have no caller to see their errors
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Remote fetch failed: %s", task.exception())
+
+def _remote_fetch_in_flight(key: Tuple) -> Optional[asyncio.Task]:
+    task = _remote_fetches.get(key)
+    if task is not None and not task.done() and task.get_loop() is asyncio.get_running_loop():
+        return task
+    return None
+
+def _remote_fetch(
+    key: Tuple,
+    command_args: List[str],
+    priority: Optional[str] = None,
+    ctx: Optional[Context] = None
+) -> asyncio.Task:
+    """Start (or join) the single in-flight fetch for key.
+    
+    ctx is the foreground caller that starts the fetch, which gets its progress and output;
+    callers joining it, and background revalidations, get neither.
+    """
+    task = _remote_fetch_in_flight(key)
+    if task is not None:
+        return task
+    
+    async def fetch() -> CommandResult:
+        try:
+            result = await _execute_cursor_tools(command_args, ctx, priority=priority)
+            if result.ok:
+                _remote_cache[key] = RemoteCacheEntry(result=result, fetched_at=time.monotonic())
+            return result
+        finally:
+            _remote_fetches.pop(key, None)
+    
+    task = asyncio.ensure_future(fetch())
+    task.add_done_callback(_remote_fetch_done)
+    _remote_fetches[key] = task
+    return task
+
+async def run_cached_remote(
+    key: Tuple,
+    command_args: List[str],
+    ctx: Optional[Context] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None
+) -> Union[str, Dict[str, Any]]:
+    """Run a remote lookup through the stale-while-revalidate cache."""
+    if REMOTE_CACHE_HARD_TTL <= 0:
+        return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
+    
+    start_time = time.time()
+    entry = _remote_cache.get(key)
+    if entry is not None:
+        age = time.monotonic() - entry.fetched_at
+        if age < REMOTE_CACHE_HARD_TTL:
+            stale = age >= REMOTE_CACHE_SOFT_TTL
+            if stale:
+                # Nobody waits on a revalidation
+                _remote_fetch(key, command_args, "bulk")
+            if ctx:
+                await ctx.info(f"Served from cache (age {age:.0f}s)")
+            result = replace(entry.result, cache="stale" if stale else "hit")
+            record_invocation(command_args, current_working_directory, replace(result, duration=time.time() - start_time))
+            return render_result(result, structured)
+        del _remote_cache[key]
+    
+    # Only the call that starts a fetch has its child logged; joiners are logged here
+    joined = _remote_fetch_in_flight(key) is not None
+    if joined and ctx:
+        await ctx.info(f"Waiting for an identical fetch in progress: {' '.join(command_args)}")
+    result = await asyncio.shield(_remote_fetch(key, command_args, priority, ctx))
+    if joined:
+        record_invocation(command_args, current_working_directory, replace(result, cache="shared", duration=time.time() - start_time))
+    return render_result(replace(result, cache="miss"), structured)
+
+# Near-duplicate cache for ask and web (VIBE_TOOLS_SEMANTIC_CACHE=1). Queries are normalized,
+# shingled and indexed with MinHash/LSH so rephrasings of a cached question are answered
+# locally; candidates are confirmed with exact Jaccard similarity. Fully offline.
+semantic_cache_enabled = os.environ.get('VIBE_TOOLS_SEMANTIC_CACHE', '').lower() in ('1', 'true', 'yes')
+try:
+    SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('VIBE_TOOLS_SEMANTIC_CACHE_THRESHOLD', '0.8'))
+    SEMANTIC_CACHE_TTL = float(os.environ.get('VIBE_TOOLS_SEMANTIC_CACHE_TTL', '3600'))
+except ValueError:
+    SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL = 0.8, 3600.0
+SEMANTIC_CACHE_MAX_ENTRIES = _env_int('VIBE_TOOLS_SEMANTIC_CACHE_MAX_ENTRIES', 512)
+# Total stdout/stderr kept across entries; web answers in particular can be large
+SEMANTIC_CACHE_MAX_BYTES = _env_int('VIBE_TOOLS_SEMANTIC_CACHE_MAX_BYTES', 32 * 1024 * 1024)
+
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16
+_MINHASH_PRIME = (1 << 61) - 1
+_MINHASH_PARAMS = [
+    (int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % _MINHASH_PRIME or 1,
+     int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _MINHASH_PRIME)
+    for i in range(MINHASH_PERMUTATIONS)
+]
+
+# Words that carry the phrasing of a question rather than its subject
+QUERY_STOPWORDS = {
+    "a", "an", "the", "of", "to", "in", "on", "for", "is", "are", "was", "be", "it", "its", "this", "that",
+    "what", "whats", "does", "do", "did", "can", "could", "would", "you",
+    "me", "i", "please", "explain", "describe", "tell", "about", "give", "show", "briefly", "mean", "means",
+    "work", "works", "and", "or", "with"
+}
+
+def normalize_query(query: str) -> List[str]:
+    """Lowercase, strip punctuation, drop phrasing words and plurals; returns the remaining terms."""
+    words = re.findall(r"[a-z0-9_]+", query.lower().replace("'", ""))
+    terms = [word for word in words if word not in QUERY_STOPWORDS] or words
+    # Plural-insensitive: "files" and "file" are the same term
+    return [term[:-1] if len(term) > 3 and term.endswith("s") and not term.endswith("ss") else term for term in terms]
+
+NEGATION_WORDS = {"not", "no", "never", "without", "none", "nor", "cannot"}
+# Question words that ask for a different kind of answer ("how" vs "why"); "what" is left
+# out since "what is X" and "explain X" ask the same thing
+QUESTION_WORDS = {"how", "why", "when", "where", "which", "who"}
+# Stems of contractions once the apostrophe is dropped: "isnt" -> "is"
+NEGATED_CONTRACTIONS = {"is", "are", "was", "were", "do", "does", "did", "can", "could", "would", "should", "wo", "has", "have", "had", "ai"}
+
+def query_anchors(query: str) -> frozenset:
+    """Tokens a near-duplicate must repeat exactly: numbers (versions, ids), negations and
+    question words.
+    
+    Trigram overlap barely notices "version 1" vs "version 2", an added "not" or "how"
+    turned into "why", yet each changes the answer.
+    """
+    words = re.findall(r"[a-z0-9_]+", query.lower().replace("'", ""))
+    anchors = set()
+    for word in words:
+        if any(char.isdigit() for char in word) or word in QUESTION_WORDS:
+            anchors.add(word)
+        elif word in NEGATION_WORDS or (word.endswith("nt") and word[:-2] in NEGATED_CONTRACTIONS):
+            # "isn't", "doesn't" and "not" all negate alike
+            anchors.add("not")
+    return frozenset(anchors)
+
+def query_shingles(terms: List[str]) -> set:
+    """Whole terms, character trigrams and word bigrams.
     
-    # Format the response
-    stdout = "\n".join(stdout_lines)
-    stderr = "\n".join(stderr_lines)
+    Trigrams let small spelling and inflection changes overlap; bigrams (with start and end
+    markers) keep word order, so "yaml to json" and "json to yaml" are not the same set.
+    """
+    shingles = set(terms)
+    for term in terms:
+        padded = f" {term} "
+        shingles.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    bounded = ["^"] + terms + ["$"]
+    shingles.update(f"{first}>{second}" for first, second in zip(bounded, bounded[1:]))
+    return shingles
+
+def same_term_order(terms: List[str], other: List[str]) -> bool:
+    """Whether the terms two queries share appear in the same relative order in both.
     
-    if returncode == 0:
-        return f"Command successful:\n{stdout}"
+    Swapping two terms ("is pandas faster than polars") usually swaps the meaning, however
+    much of the wording overlaps.
+    """
+    shared = set(terms) & set(other)
+    return [term for term in dict.fromkeys(terms) if term in shared] == [term for term in dict.fromkeys(other) if term in shared]
+
+def minhash_signature(shingles: set) -> Tuple[int, ...]:
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big") for s in shingles]
+    if not hashes:
+        return tuple([0] * MINHASH_PERMUTATIONS)
+    return tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in _MINHASH_PARAMS)
+
+@dataclass
+class SemanticCacheEntry:
+    partition: Tuple
+    normalized: str
+    anchors: frozenset
+    shingles: set
+    signature: Tuple[int, ...]
+    result: CommandResult
+    stored_at: float
+    size: int = 0
+
+class SemanticCache:
+    """Bounded LRU of answers, searchable by query similarity within a partition.
+    
+    A partition holds everything besides the query that changes the answer (tool,
+    provider, model, limits); answers are only ever shared within one partition. Both the
+    entry count and the bytes of stored output are bounded.
+    """
+
+    def __init__(self, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 ttl: float = SEMANTIC_CACHE_TTL, max_bytes: int = SEMANTIC_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries: "collections.OrderedDict[int, SemanticCacheEntry]" = collections.OrderedDict()
+        self._buckets: Dict[Tuple, set] = {}
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _bands(self, partition: Tuple, signature: Tuple[int, ...]):
+        rows = MINHASH_PERMUTATIONS // LSH_BANDS
+        for band in range(LSH_BANDS):
+            yield (partition, band, signature[band * rows:(band + 1) * rows])
+
+    def _remove(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        self.total_bytes -= entry.size
+        for bucket_key in self._bands(entry.partition, entry.signature):
+            bucket = self._buckets.get(bucket_key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[bucket_key]
+
+    def lookup(self, partition: Tuple, query: str) -> Optional[Tuple[SemanticCacheEntry, float]]:
+        """Best cached entry at or above the similarity threshold, with its similarity."""
+        terms = normalize_query(query)
+        normalized = " ".join(terms)
+        anchors = query_anchors(query)
+        shingles = query_shingles(terms)
+        signature = minhash_signature(shingles)
+        candidates = set()
+        for bucket_key in self._bands(partition, signature):
+            candidates.update(self._buckets.get(bucket_key, ()))
+        
+        best = None
+        now = time.monotonic()
+        for entry_id in candidates:
+            entry = self._entries[entry_id]
+            if now - entry.stored_at > self.ttl:
+                self._remove(entry_id)
+                continue
+            if entry.anchors != anchors:
+                continue
+            if entry.normalized == normalized:
+                similarity = 1.0
+            elif not same_term_order(terms, entry.normalized.split(" ")):
+                continue
+            else:
+                similarity = len(shingles & entry.shingles) / len(shingles | entry.shingles)
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (entry_id, similarity)
+        if best is None:
+            return None
+        self._entries.move_to_end(best[0])
+        return self._entries[best[0]], best[1]
+
+    def store(self, partition: Tuple, query: str, result: CommandResult) -> None:
+        size = len(result.stdout.encode()) + len(result.stderr.encode())
+        if size > self.max_bytes:
+            return
+        terms = normalize_query(query)
+        shingles = query_shingles(terms)
+        entry = SemanticCacheEntry(
+            partition=partition,
+            normalized=" ".join(terms),
+            anchors=query_anchors(query),
+            shingles=shingles,
+            signature=minhash_signature(shingles),
+            result=result,
+            stored_at=time.monotonic(),
+            size=size
+        )
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = entry
+        self.total_bytes += size
+        for bucket_key in self._bands(partition, entry.signature):
+            self._buckets.setdefault(bucket_key, set()).add(entry_id)
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+_semantic_cache = SemanticCache()
+
+async def run_semantic_cached(
+    partition: Tuple,
+    query: str,
+    command_args: List[str],
+    ctx: Optional[Context] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None
+) -> Union[str, Dict[str, Any]]:
+    """Answer from the near-duplicate cache when possible, otherwise run and remember the answer."""
+    start_time = time.time()
+    match = _semantic_cache.lookup(partition, query)
+    if match is not None:
+        entry, similarity = match
+        if ctx:
+            await ctx.info(f"Served from cache (similarity {similarity:.2f} to an earlier query)")
+        result = replace(entry.result, cache="hit" if similarity == 1.0 else "similar")
+        record_invocation(command_args, current_working_directory, replace(result, duration=time.time() - start_time))
+        return render_result(result, structured)
+    result = await _execute_cursor_tools(command_args, ctx, priority=priority)
+    if result.ok:
+        _semantic_cache.store(partition, query, result)
+    return render_result(replace(result, cache="miss"), structured)
+
+# Directories never worth sending to a model
+DEFAULT_SKIP_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv", ".tox", "dist", "build"}
+
+# A directory is only split into its children when its own files are a small part of it,
+# since files sitting directly in a split directory are not covered by any shard
+SHARD_MAX_LOOSE_FRACTION = 0.1
+
+# Single argv entries are limited to 128 KiB (in bytes) on Linux, and vibe-tools ask only
+# takes its query as an argument; keep the combining query below that
+SHARD_COMBINE_MAX_BYTES = 96 * 1024
+
+# Share of the combining query given to the contents of files no shard covers, and to the
+# names of those that did not fit
+SHARD_UNCOVERED_MAX_BYTES = 16 * 1024
+SHARD_UNCOVERED_NAMES_MAX_BYTES = 2 * 1024
+
+# Upper bound on shards per call, so each part keeps a useful share of the combining query
+SHARD_MAX_COUNT = 16
+
+# Shard plans keyed by (root, shard count) -> (fingerprint, (plan, uncovered files))
+_shard_plan_cache: Dict[Tuple[str, int], Tuple[str, Tuple[List[str], List[str]]]] = {}
+# Planning runs in worker threads, invalidation on the watcher thread, prefetch on the loop
+_shard_plan_cache_lock = threading.Lock()
+
+def _iter_tree(root: str, ignore_patterns: Optional[List[Tuple[str, bool, bool]]] = None):
+    """Yield (relative directory, entries) for every directory under root.
+    
+    Skips DEFAULT_SKIP_DIRS and, when given, directories matched by ignore_patterns.
+    """
+    stack = [""]
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            with os.scandir(os.path.join(root, rel_dir)) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        yield rel_dir, entries
+        for entry in entries:
+            if entry.name in DEFAULT_SKIP_DIRS:
+                continue
+            try:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+            except OSError:
+                continue
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            if ignore_patterns and is_ignored(rel_path, True, ignore_patterns):
+                continue
+            stack.append(rel_path)
+
+def _working_directory_fingerprint(root: str) -> str:
+    """Cheap fingerprint of a tree: directory paths and mtimes only.
+    
+    Adding, removing or renaming files changes the mtime of the containing directory,
+    which is what invalidates a shard plan.
+    """
+    watcher = _watchers.get(root)
+    if watcher and watcher.ready:
+        # Structural events bump the generation, so no walk is needed
+        return f"watch:{id(watcher)}:{watcher.structure_generation}"
+    digest = hashlib.sha1(root.encode())
+    for rel_dir, _ in _iter_tree(root):
+        try:
+            mtime = os.stat(os.path.join(root, rel_dir)).st_mtime_ns
+        except OSError:
+            continue
+        digest.update(f"{rel_dir}\0{mtime}\n".encode())
+    return digest.hexdigest()
+
+def _scan_file_sizes(root: str) -> Dict[str, int]:
+    """Map relative file paths under root to their size in bytes."""
+    sizes = {}
+    for rel_dir, entries in _iter_tree(root):
+        for entry in entries:
+            try:
+                if entry.is_file(follow_symlinks=False):
+                    sizes[f"{rel_dir}/{entry.name}" if rel_dir else entry.name] = entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+    return sizes
+
+def plan_shards(file_sizes: Dict[str, int], shard_count: int) -> List[str]:
+    """Split a tree into at most shard_count subdirectories of balanced size.
+    
+    Starting from the root, the largest splittable directory is repeatedly replaced by its
+    non-empty child directories while the plan stays within shard_count. Returns relative
+    subdirectory paths ("" is the root itself), largest first.
+    """
+    totals: Dict[str, int] = {}
+    loose: Dict[str, int] = {}
+    children: Dict[str, set] = {}
+    for path, size in file_sizes.items():
+        parts = path.split("/")
+        parent = "/".join(parts[:-1])
+        loose[parent] = loose.get(parent, 0) + size
+        for depth in range(len(parts)):
+            directory = "/".join(parts[:depth])
+            totals[directory] = totals.get(directory, 0) + size
+            if depth:
+                children.setdefault("/".join(parts[:depth - 1]), set()).add(directory)
+    
+    def splittable(directory: str) -> bool:
+        kids = [kid for kid in children.get(directory, ()) if totals.get(kid)]
+        if not kids:
+            return False
+        return loose.get(directory, 0) <= totals[directory] * SHARD_MAX_LOOSE_FRACTION
+    
+    plan = [""]
+    while True:
+        for directory in sorted(plan, key=lambda d: totals.get(d, 0), reverse=True):
+            if not splittable(directory):
+                continue
+            kids = [kid for kid in children[directory] if totals.get(kid)]
+            if len(plan) - 1 + len(kids) <= shard_count:
+                plan.remove(directory)
+                plan.extend(kids)
+                break
+        else:
+            break
+    return sorted(plan, key=lambda d: (-totals.get(d, 0), d))
+
+def uncovered_files(file_sizes: Dict[str, int], plan: List[str]) -> List[str]:
+    """Files under no shard of plan: those sitting directly in a directory that was split."""
+    if "" in plan:
+        return []
+    prefixes = tuple(subdir + "/" for subdir in plan)
+    return sorted(path for path in file_sizes if not path.startswith(prefixes))
+
+def get_shard_plan(root: str, shard_count: int) -> Tuple[List[str], List[str]]:
+    """Return the shard plan for root and the files it leaves uncovered, reusing the cached
+    plan while the tree fingerprint holds."""
+    fingerprint = _working_directory_fingerprint(root)
+    with _shard_plan_cache_lock:
+        cached = _shard_plan_cache.get((root, shard_count))
+    if cached and cached[0] == fingerprint:
+        return cached[1]
+    if context_index_enabled:
+        # The index already applies ignore rules and only restats what changed
+        index = update_context_index(root)
+        sizes = {path: entry.size for path, entry in index.files.items()}
     else:
-        return f"Command failed with code {returncode}:\nStdout:\n{stdout}\nStderr:\n{stderr}"
+        sizes = _scan_file_sizes(root)
+    plan = plan_shards(sizes, shard_count)
+    result = (plan, uncovered_files(sizes, plan))
+    with _shard_plan_cache_lock:
+        _shard_plan_cache[(root, shard_count)] = (fingerprint, result)
+    return result
+
+# Context index: keeps an ignore-rule-applied file list of each working directory up to date
+# from mtime changes (or watcher events), so shard planning does not walk the tree per call
+context_index_enabled = os.environ.get('VIBE_TOOLS_CONTEXT_INDEX', '').lower() in ('1', 'true', 'yes')
+
+# Ignore files read from the root of the working directory
+CONTEXT_IGNORE_FILES = [".gitignore", ".repomixignore"]
+
+@dataclass
+class IndexedFile:
+    """One file of a context index."""
+    mtime_ns: int
+    size: int
+
+@dataclass
+class ContextIndex:
+    """Indexed files of one working directory."""
+    root: str
+    files: Dict[str, IndexedFile]
+    ignore_signature: Tuple[int, ...] = ()
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+_context_indexes: Dict[str, ContextIndex] = {}
+_context_indexes_lock = threading.Lock()
+
+def _cache_dir_path() -> pathlib.Path:
+    """Directory for on-disk server state (VIBE_TOOLS_MCP_CACHE_DIR or ~/.cache/mcp-vibe-tools), without creating it."""
+    configured = os.environ.get('VIBE_TOOLS_MCP_CACHE_DIR')
+    return pathlib.Path(configured) if configured else pathlib.Path.home() / ".cache" / "mcp-vibe-tools"
+
+def _cache_dir() -> pathlib.Path:
+    """The server state directory, created if missing."""
+    path = _cache_dir_path()
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+def load_ignore_patterns(root: str) -> List[Tuple[str, bool, bool]]:
+    """Read gitignore-style patterns as (pattern, directory_only, anchored) tuples.
+    
+    Supports comments, trailing-slash directory patterns, leading-slash anchoring and globs.
+    Negated patterns (!) are not supported and are skipped.
+    """
+    patterns = []
+    for name in CONTEXT_IGNORE_FILES:
+        try:
+            with open(os.path.join(root, name), "r", errors="replace") as f:
+                lines = f.read().splitlines()
+        except OSError:
+            continue
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#") or line.startswith("!"):
+                continue
+            directory_only = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            patterns.append((line.lstrip("/"), directory_only, anchored))
+    return patterns
+
+def is_ignored(rel_path: str, is_dir: bool, patterns: List[Tuple[str, bool, bool]]) -> bool:
+    """Check a relative posix path against patterns from load_ignore_patterns."""
+    name = rel_path.rsplit("/", 1)[-1]
+    for pattern, directory_only, anchored in patterns:
+        if directory_only and not is_dir:
+            continue
+        if fnmatch.fnmatchcase(rel_path if anchored else name, pattern):
+            return True
+    return False
+
+def _ignore_signature(root: str) -> Tuple[int, ...]:
+    """mtimes of the ignore files; a change means the whole file list must be rebuilt."""
+    signature = []
+    for name in CONTEXT_IGNORE_FILES:
+        try:
+            signature.append(os.stat(os.path.join(root, name)).st_mtime_ns)
+        except OSError:
+            signature.append(0)
+    return tuple(signature)
+
+def _index_entry(stat: os.stat_result) -> IndexedFile:
+    return IndexedFile(mtime_ns=stat.st_mtime_ns, size=stat.st_size)
+
+def _path_ignored(rel_path: str, is_dir: bool, patterns: List[Tuple[str, bool, bool]]) -> bool:
+    """Whether rel_path or any of its parent directories is excluded from the index."""
+    parts = rel_path.split("/")
+    for depth in range(1, len(parts)):
+        parent = "/".join(parts[:depth])
+        if parts[depth - 1] in DEFAULT_SKIP_DIRS or is_ignored(parent, True, patterns):
+            return True
+    if is_dir and parts[-1] in DEFAULT_SKIP_DIRS:
+        return True
+    return is_ignored(rel_path, is_dir, patterns)
+
+def _refresh_index_path(index: ContextIndex, rel_path: str, patterns: List[Tuple[str, bool, bool]]) -> bool:
+    """Bring a single changed path (file or directory) of the index up to date."""
+    path = os.path.join(index.root, rel_path)
+    changed = False
+    try:
+        stat = os.lstat(path)
+    except OSError:
+        stat = None
+    is_dir = stat is not None and S_ISDIR(stat.st_mode)
+    
+    if stat is None or is_dir:
+        # Removed path or (re)created directory: drop everything below it first
+        prefix = rel_path + "/"
+        for existing in [key for key in index.files if key == rel_path or key.startswith(prefix)]:
+            del index.files[existing]
+            changed = True
+    if stat is None or _path_ignored(rel_path, is_dir, patterns):
+        if index.files.pop(rel_path, None) is not None:
+            changed = True
+        return changed
+    
+    if is_dir:
+        for rel_dir, entries in _iter_tree(path, patterns):
+            for entry in entries:
+                child = "/".join(part for part in (rel_path, rel_dir, entry.name) if part)
+                try:
+                    if not entry.is_file(follow_symlinks=False) or is_ignored(child, False, patterns):
+                        continue
+                    index.files[child] = _index_entry(entry.stat(follow_symlinks=False))
+                    changed = True
+                except OSError:
+                    continue
+        return changed
+    
+    if not S_ISREG(stat.st_mode):
+        return changed
+    existing = index.files.get(rel_path)
+    if existing and existing.mtime_ns == stat.st_mtime_ns and existing.size == stat.st_size:
+        return changed
+    index.files[rel_path] = _index_entry(stat)
+    return True
+
+def update_context_index(root: str) -> ContextIndex:
+    """Build or incrementally refresh the context index for root.
+    
+    Entries are replaced only for files whose mtime or size changed. While a watcher runs
+    for root, only the paths it reported are revisited instead of walking the tree.
+    Blocking: call from a worker thread.
+    """
+    with _context_indexes_lock:
+        index = _context_indexes.get(root)
+        if index is None:
+            index = ContextIndex(root=root, files={})
+            _context_indexes[root] = index
+    
+    with index.lock:
+        watcher = _watchers.get(root)
+        changes = watcher.drain("context_index") if watcher else None
+        signature = _ignore_signature(root)
+        if signature != index.ignore_signature:
+            index.files = {}
+            index.ignore_signature = signature
+        patterns = load_ignore_patterns(root)
+        
+        if changes is not None and not changes.full_rescan and index.files:
+            # Only revisit what the watcher saw change
+            for rel_path in changes.paths:
+                _refresh_index_path(index, rel_path, patterns)
+            return index
+        
+        seen = set()
+        for rel_dir, entries in _iter_tree(root, patterns):
+            for entry in entries:
+                rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                try:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if is_ignored(rel_path, False, patterns):
+                    continue
+                seen.add(rel_path)
+                existing = index.files.get(rel_path)
+                if existing and existing.mtime_ns == stat.st_mtime_ns and existing.size == stat.st_size:
+                    continue
+                index.files[rel_path] = _index_entry(stat)
+        
+        for rel_path in set(index.files) - seen:
+            del index.files[rel_path]
+    return index
+
+# Filesystem watcher: started by set_working_directory when VIBE_TOOLS_WATCH is set, so caches
+# learn what changed from events instead of rescanning the whole tree on every call
+watch_enabled = os.environ.get('VIBE_TOOLS_WATCH', '').lower() in ('1', 'true', 'yes')
+try:
+    WATCH_DEBOUNCE_SECONDS = float(os.environ.get('VIBE_TOOLS_WATCH_DEBOUNCE', '0.5'))
+except ValueError:
+    WATCH_DEBOUNCE_SECONDS = 0.5
+WATCH_POLL_INTERVAL = 2.0
+
+# More pending paths than this (git checkout, builds) collapse into a single full rescan
+WATCH_STORM_THRESHOLD = 10000
+
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK_CLOEXEC = 0o4000 | 0o2000000
+_IN_STRUCTURE = _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+_IN_WATCH_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_STRUCTURE
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+@dataclass
+class WatchChanges:
+    """Paths changed since a consumer last drained a watcher."""
+    paths: set
+    full_rescan: bool
+
+class DirectoryWatcher:
+    """Collects changed paths under a root using inotify, falling back to polling.
+    
+    Each consumer drains its own dirty-set, so the context index and the shard planner
+    see the same events independently. A consumer's first drain always asks for a full
+    rescan since nothing was tracked for it before.
+    """
+
+    def __init__(self, root: str, on_settled=None, backend: Optional[str] = None,
+                 debounce: float = WATCH_DEBOUNCE_SECONDS, poll_interval: float = WATCH_POLL_INTERVAL):
+        self.root = root
+        self.backend = backend or ("inotify" if sys.platform.startswith("linux") else "polling")
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.structure_generation = 0
+        self.ready = False
+        self._on_settled = on_settled
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._consumers: Dict[str, WatchChanges] = {}
+        self._pending_settle = False
+        self._structure_changed = False
+        self._last_event = 0.0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(target=self._run, name=f"watch:{self.root}", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def drain(self, consumer: str) -> WatchChanges:
+        """Return and reset the changes recorded for consumer."""
+        with self._lock:
+            changes = self._consumers.get(consumer)
+            self._consumers[consumer] = WatchChanges(paths=set(), full_rescan=False)
+        if changes is None or not self.ready:
+            return WatchChanges(paths=set(), full_rescan=True)
+        return changes
+
+    def _record(self, rel_path: Optional[str], structural: bool) -> None:
+        """Mark rel_path dirty for every consumer; None forces a full rescan."""
+        with self._lock:
+            for changes in self._consumers.values():
+                if changes.full_rescan:
+                    continue
+                if rel_path is None or len(changes.paths) >= WATCH_STORM_THRESHOLD:
+                    changes.paths.clear()
+                    changes.full_rescan = True
+                else:
+                    changes.paths.add(rel_path)
+            if structural or rel_path is None:
+                self.structure_generation += 1
+                self._structure_changed = True
+            self._pending_settle = True
+            self._last_event = time.monotonic()
+
+    def _maybe_settle(self) -> None:
+        """Notify on_settled once events have been quiet for the debounce window."""
+        with self._lock:
+            if not self._pending_settle or time.monotonic() - self._last_event < self.debounce:
+                return
+            structure_changed = self._structure_changed
+            self._pending_settle = False
+            self._structure_changed = False
+        if self._on_settled:
+            try:
+                self._on_settled(self, structure_changed)
+            except Exception as e:
+                logger.warning("Watch callback failed for %s: %s", self.root, e)
+
+    def _run(self) -> None:
+        if self.backend == "inotify":
+            try:
+                self._run_inotify()
+                return
+            except OSError as e:
+                # e.g. max_user_watches exhausted; polling still works
+                logger.warning("inotify unavailable for %s (%s), falling back to polling", self.root, e)
+                self.backend = "polling"
+                self.ready = False
+                self._record(None, True)
+        self._run_polling()
+
+    def _run_inotify(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(_IN_NONBLOCK_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        watches: Dict[int, str] = {}
+
+        def add_tree(rel_root: str) -> None:
+            base = os.path.join(self.root, rel_root) if rel_root else self.root
+            for rel_dir, _ in _iter_tree(base):
+                rel = "/".join(part for part in (rel_root, rel_dir) if part)
+                path = os.path.join(self.root, rel) if rel else self.root
+                wd = libc.inotify_add_watch(fd, os.fsencode(path), _IN_WATCH_MASK)
+                if wd < 0:
+                    errno = ctypes.get_errno()
+                    if errno == 28:  # ENOSPC: out of watches
+                        raise OSError(errno, "inotify watch limit reached")
+                    continue
+                watches[wd] = rel
+
+        try:
+            add_tree("")
+            self.ready = True
+            while not self._stop.is_set():
+                readable, _, _ = select.select([fd], [], [], min(self.debounce, 0.5) or 0.1)
+                if not readable:
+                    self._maybe_settle()
+                    continue
+                try:
+                    data = os.read(fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                offset = 0
+                while offset + _INOTIFY_EVENT.size <= len(data):
+                    wd, mask, _, name_len = _INOTIFY_EVENT.unpack_from(data, offset)
+                    offset += _INOTIFY_EVENT.size
+                    name = os.fsdecode(data[offset:offset + name_len].rstrip(b"\0"))
+                    offset += name_len
+                    if mask & _IN_Q_OVERFLOW:
+                        self._record(None, True)
+                        continue
+                    if mask & _IN_IGNORED:
+                        watches.pop(wd, None)
+                        continue
+                    rel_dir = watches.get(wd)
+                    if rel_dir is None or not name or name in DEFAULT_SKIP_DIRS:
+                        continue
+                    rel_path = f"{rel_dir}/{name}" if rel_dir else name
+                    if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                        add_tree(rel_path)
+                    self._record(rel_path, bool(mask & _IN_STRUCTURE))
+                self._maybe_settle()
+        finally:
+            os.close(fd)
+
+    def _snapshot(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for rel_dir, entries in _iter_tree(self.root):
+            for entry in entries:
+                if entry.name in DEFAULT_SKIP_DIRS:
+                    continue
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                snapshot[f"{rel_dir}/{entry.name}" if rel_dir else entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def _run_polling(self) -> None:
+        previous = self._snapshot()
+        self.ready = True
+        next_poll = time.monotonic() + self.poll_interval
+        while not self._stop.wait(min(self.debounce, self.poll_interval) or 0.1):
+            if time.monotonic() >= next_poll:
+                current = self._snapshot()
+                for rel_path in previous.keys() ^ current.keys():
+                    self._record(rel_path, True)
+                for rel_path in previous.keys() & current.keys():
+                    if previous[rel_path] != current[rel_path]:
+                        self._record(rel_path, False)
+                previous = current
+                next_poll = time.monotonic() + self.poll_interval
+            self._maybe_settle()
+
+_watchers: Dict[str, DirectoryWatcher] = {}
+
+def _on_watch_settled(watcher: DirectoryWatcher, structure_changed: bool) -> None:
+    """Invalidate caches for the watched root as soon as an event burst is over."""
+    if structure_changed:
+        with _shard_plan_cache_lock:
+            for key in [key for key in _shard_plan_cache if key[0] == watcher.root]:
+                del _shard_plan_cache[key]
+    if watcher.root in _context_indexes:
+        update_context_index(watcher.root)
+
+def start_watcher(root: str) -> DirectoryWatcher:
+    """Watch root for changes, stopping watchers of any previous working directory."""
+    for other in [path for path in _watchers if path != root]:
+        _watchers.pop(other).stop()
+    watcher = _watchers.get(root)
+    if watcher is None:
+        watcher = DirectoryWatcher(root, on_settled=_on_watch_settled)
+        _watchers[root] = watcher
+        watcher.start()
+    return watcher
+
+# Background warm-up after set_working_directory (VIBE_TOOLS_PREFETCH=1)
+prefetch_enabled = os.environ.get('VIBE_TOOLS_PREFETCH', '').lower() in ('1', 'true', 'yes')
+PREFETCH_IDLE_POLL_SECONDS = 0.5
+
+_prefetch_task: Optional[asyncio.Task] = None
+
+async def _wait_until_idle() -> None:
+    """Low priority: only proceed while no foreground command is running."""
+    while _scheduler.running:
+        await asyncio.sleep(PREFETCH_IDLE_POLL_SECONDS)
+
+async def prefetch_working_directory(root: str) -> None:
+    """Warm the caches the first repo/plan/github call in root would otherwise fill.
+    
+    Steps run one at a time and only while the server is idle: refresh shard plans already
+    used this session, build the context index, then fetch the PR and issue lists into the
+    remote cache.
+    """
+    started = time.time()
+    with _shard_plan_cache_lock:
+        counts = sorted({count for _, count in _shard_plan_cache})
+    for count in counts:
+        await _wait_until_idle()
+        await asyncio.to_thread(get_shard_plan, root, count)
+    
+    if context_index_enabled:
+        await _wait_until_idle()
+        await asyncio.to_thread(update_context_index, root)
+    
+    if REMOTE_CACHE_HARD_TTL > 0 and os.path.exists(os.path.join(root, ".git")):
+        for kind in ("pr", "issue"):
+            key = (f"github_{kind}", root, None)
+            entry = _remote_cache.get(key)
+            if entry and time.monotonic() - entry.fetched_at < REMOTE_CACHE_SOFT_TTL:
+                continue
+            await _wait_until_idle()
+            # Fetched directly rather than through _remote_fetch so cancelling the
+            # prefetch never cancels a fetch a foreground call is waiting on
+            result = await _execute_cursor_tools(
+                build_command_args([cursor_tools_exec, "github", kind], {}), priority="bulk"
+            )
+            if result.ok:
+                _remote_cache[key] = RemoteCacheEntry(result=result, fetched_at=time.monotonic())
+    logger.info("Prefetch for %s finished in %.2f seconds", root, time.time() - started)
+
+def _prefetch_done(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Prefetch failed: %s", task.exception())
+
+def start_prefetch(root: str) -> asyncio.Task:
+    """Start warming root, cancelling the warm-up of any previous working directory."""
+    global _prefetch_task
+    if _prefetch_task is not None and not _prefetch_task.done():
+        _prefetch_task.cancel()
+    _prefetch_task = asyncio.ensure_future(prefetch_working_directory(root))
+    _prefetch_task.add_done_callback(_prefetch_done)
+    return _prefetch_task
+
+async def run_sharded(
+    subcommand: str,
+    query: Optional[str],
+    params: Dict[str, Any],
+    shard_count: int,
+    root: str,
+    save_to: Optional[str] = None,
+    ctx: Optional[Context] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None
+) -> Union[str, Dict[str, Any]]:
+    """Run `repo` or `doc` once per shard in parallel, then merge the answers with a combining `ask` call.
+    
+    `repo` shards run with --subdir; `doc` has no such option, so each doc shard runs with its
+    subtree as the working directory. Files no shard covers (those directly inside a split
+    directory) are passed to the combining call. A tree that cannot be split runs unsharded.
+    """
+    start_time = time.time()
+    if priority is None:
+        priority = default_lane([cursor_tools_exec, subcommand])
+    shard_count = min(shard_count, SHARD_MAX_COUNT)
+    plan, uncovered = await asyncio.to_thread(get_shard_plan, root, shard_count)
+    if ctx:
+        await ctx.info(f"Sharded {subcommand}: {len(plan)} shard(s) under {root}")
+    
+    command = [cursor_tools_exec, subcommand]
+    if query:
+        command.append(query)
+    
+    async def run_shard(subdir: str, shard_ctx: Optional[Context] = None, shard_save_to: Optional[str] = None) -> CommandResult:
+        directory = os.path.join(root, subdir) if subdir else root
+        if subcommand == "repo":
+            shard_params = dict(params, subdir=directory, save_to=shard_save_to)
+            command_args = build_command_args(command, shard_params, path_params=["subdir", "save_to"])
+            return await _execute_cursor_tools(command_args, shard_ctx, priority=priority)
+        shard_params = dict(params, output=shard_save_to)
+        command_args = build_command_args(command, shard_params, path_params=["output"])
+        return await _execute_cursor_tools(command_args, shard_ctx, priority=priority, execution_dir=directory)
+    
+    if len(plan) == 1 and not uncovered:
+        # Nothing to combine
+        result = await run_shard(plan[0], ctx, save_to)
+        return render_result(replace(result, duration=time.time() - start_time), structured)
+    
+    completed = 0
+    async def tracked(subdir: str) -> CommandResult:
+        nonlocal completed
+        result = await run_shard(subdir)
+        completed += 1
+        if ctx:
+            await ctx.report_progress(int(completed * 95 / len(plan)), 100)
+        return result
+    
+    if ctx:
+        await ctx.report_progress(0, 100)
+    results = await asyncio.gather(*(tracked(subdir) for subdir in plan))
+    
+    answers = [(subdir or ".", result) for subdir, result in zip(plan, results) if result.ok]
+    failures = [(subdir or ".", result) for subdir, result in zip(plan, results) if not result.ok]
+    if not answers:
+        error = "Sharded command failed in every shard:\n" + "\n\n".join(
+            f"[{subdir}] {format_result(result)}" for subdir, result in failures
+        )
+        return render_result(CommandResult(returncode=None, error=error, duration=time.time() - start_time), structured)
+    
+    task = f"the question: {query}" if subcommand == "repo" else (
+        f"documentation focused on: {query}" if query else "comprehensive documentation"
+    )
+    header = (
+        f"Combine these partial results, each covering one part of the repository at {root}, "
+        f"into a single coherent answer to {task}. Remove duplication and keep every concrete detail."
+    )
+    loose_section = await asyncio.to_thread(_uncovered_files_section, root, uncovered) if uncovered else ""
+    titles = [f"## Part: {subdir}\n" for subdir, _ in answers]
+    # Everything but the answers themselves, including the blank lines joining sections
+    fixed = len(header.encode()) + len(loose_section.encode()) + sum(len(title.encode()) for title in titles) + 2 * (len(answers) + 1)
+    budget = max(0, SHARD_COMBINE_MAX_BYTES - fixed) // len(answers)
+    sections = [title + _truncate_utf8(result.stdout, budget) for title, (_, result) in zip(titles, answers)]
+    if loose_section:
+        sections.append(loose_section)
+    combine_params = {
+        "provider": params.get("provider"),
+        "model": params.get("model"),
+        "max_tokens": params.get("max_tokens"),
+        "save_to": save_to
+    }
+    combine_args = build_command_args(
+        [cursor_tools_exec, "ask", header + "\n\n" + "\n\n".join(sections)],
+        combine_params,
+        path_params=["save_to"]
+    )
+    combined = await _execute_cursor_tools(combine_args, priority=priority)
+    if ctx:
+        await ctx.report_progress(100, 100)
+    
+    if failures:
+        note = "\n\nShards that failed and are missing from this answer: " + ", ".join(
+            subdir for subdir, _ in failures
+        )
+        if combined.error is None:
+            combined = replace(combined, stdout=combined.stdout + note)
+        else:
+            combined = replace(combined, error=combined.error + note)
+    return render_result(replace(combined, duration=time.time() - start_time), structured)
+
+def _truncate_utf8(text: str, max_bytes: int) -> str:
+    """Cut text to at most max_bytes of UTF-8 without splitting a character."""
+    encoded = text.encode()
+    if len(encoded) <= max_bytes:
+        return text
+    return encoded[:max_bytes].decode(errors="ignore")
+
+def _uncovered_files_section(root: str, paths: List[str]) -> str:
+    """Combine-step section with the contents of files outside every shard, within
+    SHARD_UNCOVERED_MAX_BYTES; files that do not fit are listed by name, within
+    SHARD_UNCOVERED_NAMES_MAX_BYTES. Blocking."""
+    parts = []
+    omitted = []
+    remaining = SHARD_UNCOVERED_MAX_BYTES
+    for path in paths:
+        entry = f"### {path}\n".encode()
+        try:
+            with open(os.path.join(root, path), "rb") as f:
+                data = f.read(max(0, remaining - len(entry)) + 1)
+            content = data.decode("utf-8")
+        except (OSError, UnicodeDecodeError):
+            omitted.append(path)
+            continue
+        if len(entry) + len(data) > remaining:
+            omitted.append(path)
+            continue
+        parts.append(f"### {path}\n{content}")
+        remaining -= len(entry) + len(data) + 2
+    section = "## Files outside the parts above\n" + "\n\n".join(parts)
+    if omitted:
+        names = "\n\nNot shown (too large or binary): "
+        listed = 0
+        for path in omitted:
+            item = (", " if listed else "") + path
+            if len((names + item).encode()) > SHARD_UNCOVERED_NAMES_MAX_BYTES - 32:
+                break
+            names += item
+            listed += 1
+        if listed < len(omitted):
+            names += f" and {len(omitted) - listed} more"
+        section += names
+    return section
+
+# Multi-step browser sessions: steps are grouped into as few vibe-tools invocations as the
+# CLI allows. Consecutive act steps share one invocation (joined with "|") unless each needs
+# its own screenshot, evaluate steps run as --evaluate before the step that follows them,
+# and every invocation after the first targets the page already open through connect_to.
+BROWSER_SESSION_ACTIONS = ("act", "observe", "extract", "evaluate")
+
+@dataclass
+class BrowserInvocation:
+    """One vibe-tools browser call covering one or more session steps (1-based)."""
+    action: str
+    instructions: List[str]
+    steps: List[int]
+    evaluate: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        numbers = f"{self.steps[0]}" if len(self.steps) == 1 else f"{self.steps[0]}-{self.steps[-1]}"
+        return f"Step {numbers} ({self.action})"
+
+def plan_browser_session(steps: List[Dict[str, str]], merge_acts: bool = True) -> List[BrowserInvocation]:
+    """Group session steps into invocations; raises ValueError for malformed steps."""
+    invocations: List[BrowserInvocation] = []
+    pending_evaluate: List[str] = []
+    pending_steps: List[int] = []
+    for number, step in enumerate(steps, start=1):
+        action = step.get("action")
+        instruction = step.get("instruction")
+        if action not in BROWSER_SESSION_ACTIONS:
+            raise ValueError(f"step {number}: action must be one of {', '.join(BROWSER_SESSION_ACTIONS)}")
+        if not instruction:
+            raise ValueError(f"step {number}: instruction is required")
+        if action == "evaluate":
+            pending_evaluate.append(instruction)
+            pending_steps.append(number)
+            continue
+        previous = invocations[-1] if invocations else None
+        if merge_acts and action == "act" and previous and previous.action == "act" and not pending_evaluate:
+            previous.instructions.append(instruction)
+            previous.steps.append(number)
+            continue
+        invocations.append(BrowserInvocation(
+            action=action,
+            instructions=[instruction],
+            steps=pending_steps + [number],
+            evaluate=";\n".join(pending_evaluate) or None
+        ))
+        pending_evaluate, pending_steps = [], []
+    if pending_evaluate:
+        raise ValueError("evaluate runs before the step that follows it, so a session cannot end with evaluate")
+    if not invocations:
+        raise ValueError("at least one act, observe or extract step is required")
+    return invocations
+
+def _numbered_path(path: str, suffix: str) -> str:
+    """shots/page.png -> shots/page-step3.png"""
+    root, ext = os.path.splitext(path)
+    return f"{root}-{suffix}{ext}"
 
 @mcp.tool()
 async def set_working_directory(directory_path: str) -> str:
@@ -269,6 +2292,10 @@ async def set_working_directory(directory_path: str) -> str:
     # Check if the resolved path exists and is a directory
     if resolved_absolute_path.exists() and resolved_absolute_path.is_dir():
         current_working_directory = str(resolved_absolute_path)
+        if watch_enabled:
+            start_watcher(current_working_directory)
+        if prefetch_enabled:
+            start_prefetch(current_working_directory)
         return f"Working directory set to: {current_working_directory}"
     else:
         return f"Error: {directory_path} is not a valid directory"
@@ -288,8 +2315,10 @@ async def ask(
     model: Optional[str] = None,
     reasoning_effort: Optional[str] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Ask a direct question to an AI model.
     
     Use for simple queries without repository context. Prefer `repo` or `plan` for code-aware answers.
@@ -301,6 +2330,8 @@ async def ask(
     reasoning_effort: Control reasoning depth: low, medium, or high (optional)
     max_tokens: Maximum tokens for response (integer, optional)
     save_to: Path to save response (string, optional)
+    structured: Return a JSON object with exit code, stdout, stderr, timings and byte counts instead of text (bool, optional)
+    priority: Scheduling lane: interactive, normal or bulk; defaults per tool (string, optional)
     """
     command = [cursor_tools_exec, "ask", query]
     
@@ -315,7 +2346,10 @@ async def ask(
     path_params = ["save_to"]
     
     command_args = build_command_args(command, params, path_params)
-    return await run_cursor_tools(command_args, ctx)
+    if semantic_cache_enabled and not save_to:
+        partition = ("ask", provider, model, max_tokens, reasoning_effort)
+        return await run_semantic_cached(partition, query, command_args, ctx, structured, priority)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
 
 @mcp.tool()
 async def plan(
@@ -326,8 +2360,10 @@ async def plan(
     file_model: Optional[str] = None,
     thinking_model: Optional[str] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Generate a detailed implementation plan for a coding task.
     
     Uses multiple AI models to identify relevant files and outline steps.
@@ -340,6 +2376,8 @@ async def plan(
     thinking_model: Model for plan generation, e.g., gpt-4, claude-3, gemini-pro (optional)
     max_tokens: Maximum tokens for response (integer, optional)
     save_to: Path to save response (string, optional)
+    structured: Return a JSON object with exit code, stdout, stderr, timings and byte counts instead of text (bool, optional)
+    priority: Scheduling lane: interactive, normal or bulk; defaults per tool (string, optional)
     """
     command = [cursor_tools_exec, "plan", query]
     
@@ -355,7 +2393,7 @@ async def plan(
     path_params = ["save_to"]
     
     command_args = build_command_args(command, params, path_params)
-    return await run_cursor_tools(command_args, ctx)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
 
 @mcp.tool()
 async def web(
@@ -365,8 +2403,10 @@ async def web(
     model: Optional[str] = None,
     max_search_results: Optional[int] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Get answers from the web using an AI agent with internet access.
     
     Ideal for research, troubleshooting, or gathering up-to-date information.
@@ -378,6 +2418,8 @@ async def web(
     max_tokens: Maximum tokens for response (integer, optional)
     max_search_results: Maximum search results to consider (integer, optional)
     save_to: Path to save response (string, optional)
+    structured: Return a JSON object with exit code, stdout, stderr, timings and byte counts instead of text (bool, optional)
+    priority: Scheduling lane: interactive, normal or bulk; defaults per tool (string, optional)
     """
     command = [cursor_tools_exec, "web", query]
     
@@ -392,7 +2434,10 @@ async def web(
     path_params = ["save_to"]
     
     command_args = build_command_args(command, params, path_params)
-    return await run_cursor_tools(command_args, ctx)
+    if semantic_cache_enabled and not save_to:
+        partition = ("web", provider, model, max_tokens, max_search_results)
+        return await run_semantic_cached(partition, query, command_args, ctx, structured, priority)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
 
 @mcp.tool()
 async def repo(
@@ -404,8 +2449,11 @@ async def repo(
     repo_url: Optional[str] = None,
     subdir: Optional[str] = None,
     save_to: Optional[str] = None,
+    shards: Optional[int] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Ask questions about the current repository or a remote GitHub repo.
     
     Provides insights based on code, structure, and documentation.
@@ -419,7 +2467,19 @@ async def repo(
     repo_url: URL of GitHub repository (string, optional)
     subdir: Analyze specific subdirectory (string, optional)
     save_to: Path to save response (string, optional)
+    shards: Split the local tree into up to this many balanced subtrees, query them in parallel and combine the answers; useful for large monorepos (integer, optional)
+    structured: Return a JSON object with exit code, stdout, stderr, timings and byte counts instead of text (bool, optional)
+    priority: Scheduling lane: interactive, normal or bulk; defaults per tool (string, optional)
     """
+    if shards and shards > 1 and not from_github and not repo_url:
+        root = str((pathlib.Path(current_working_directory) / subdir).resolve()) if subdir else current_working_directory
+        params = {
+            "max_tokens": max_tokens,
+            "provider": provider,
+            "model": model
+        }
+        return await run_sharded("repo", query, params, shards, root, save_to, ctx, structured, priority)
+    
     command = [cursor_tools_exec, "repo", query]
     
     params = {
@@ -439,7 +2499,7 @@ async def repo(
     from_github_val = from_github if from_github is not None else False
     
     command_args = build_command_args(command, params, path_params, boolean_params)
-    return await run_cursor_tools(command_args, ctx, from_github_val)
+    return await run_cursor_tools(command_args, ctx, from_github_val, structured=structured, priority=priority)
 
 @mcp.tool()
 async def doc(
@@ -451,8 +2511,11 @@ async def doc(
     repo_url: Optional[str] = None,
     output: Optional[str] = None,
     save_to: Optional[str] = None,
+    shards: Optional[int] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Generate comprehensive documentation for a local or remote repository.
     
     Can focus on specific topics or files if desired.
@@ -465,7 +2528,18 @@ async def doc(
     from_github: Document remote GitHub repository (bool, optional)
     repo_url: URL of GitHub repository (string, optional)
     output: Output file path (string, optional)
+    shards: Document up to this many balanced subtrees in parallel and merge the results; useful for large monorepos (integer, optional)
+    structured: Return a JSON object with exit code, stdout, stderr, timings and byte counts instead of text (bool, optional)
+    priority: Scheduling lane: interactive, normal or bulk; defaults per tool (string, optional)
     """
+    if shards and shards > 1 and not from_github and not repo_url:
+        params = {
+            "max_tokens": max_tokens,
+            "provider": provider,
+            "model": model
+        }
+        return await run_sharded("doc", query, params, shards, current_working_directory, output or save_to, ctx, structured, priority)
+    
     command = [cursor_tools_exec, "doc"]
     if query:
         command.append(query)
@@ -490,7 +2564,7 @@ async def doc(
     from_github_val = from_github if from_github is not None else False
     
     command_args = build_command_args(command, params, path_params, boolean_params)
-    return await run_cursor_tools(command_args, ctx, from_github_val)
+    return await run_cursor_tools(command_args, ctx, from_github_val, structured=structured, priority=priority)
 
 @mcp.tool()
 async def youtube(
@@ -498,8 +2572,10 @@ async def youtube(
     query: Optional[str] = None,
     type: Optional[Literal["summary", "transcript", "plan", "review", "custom"]] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Analyze YouTube videos and generate detailed reports.
     
     Requires GEMINI_API_KEY in environment or .cursor-tools.env file.
@@ -515,18 +2591,21 @@ async def youtube(
     path_params = ["save_to"]
     
     command_args = build_command_args(command, params, path_params)
-    return await run_cursor_tools(command_args, ctx)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
 
 @mcp.tool()
 async def github_pr(
     number: Optional[int] = None,
     from_github: Optional[str] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Get information about GitHub pull requests.
     
-    Returns the last 10 PRs or a specific PR by number.
+    Returns the last 10 PRs or a specific PR by number. Results are cached per repository
+    and refreshed in the background once stale.
     """
     command = [cursor_tools_exec, "github", "pr"]
     if number is not None:
@@ -539,18 +2618,24 @@ async def github_pr(
     path_params = ["save_to"]
     
     command_args = build_command_args(command, params, path_params)
-    return await run_cursor_tools(command_args, ctx)
+    if save_to:
+        return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
+    key = ("github_pr", from_github or current_working_directory, number)
+    return await run_cached_remote(key, command_args, ctx, structured, priority)
 
 @mcp.tool()
 async def github_issue(
     number: Optional[int] = None,
     from_github: Optional[str] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Get information about GitHub issues.
     
-    Returns the last 10 issues or a specific issue by number.
+    Returns the last 10 issues or a specific issue by number. Results are cached per repository
+    and refreshed in the background once stale.
     """
     command = [cursor_tools_exec, "github", "issue"]
     if number is not None:
@@ -563,17 +2648,23 @@ async def github_issue(
     path_params = ["save_to"]
     
     command_args = build_command_args(command, params, path_params)
-    return await run_cursor_tools(command_args, ctx)
+    if save_to:
+        return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
+    key = ("github_issue", from_github or current_working_directory, number)
+    return await run_cached_remote(key, command_args, ctx, structured, priority)
 
 @mcp.tool()
 async def clickup_task(
     task_id: str,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Get detailed information about a ClickUp task.
     
-    Requires CLICKUP_API_TOKEN in .cursor-tools.env file.
+    Requires CLICKUP_API_TOKEN in .cursor-tools.env file. Results are cached per task
+    and refreshed in the background once stale.
     """
     command = [cursor_tools_exec, "clickup", "task", task_id]
     params = {
@@ -582,15 +2673,21 @@ async def clickup_task(
     path_params = ["save_to"]
     
     command_args = build_command_args(command, params, path_params)
-    return await run_cursor_tools(command_args, ctx)
+    if save_to:
+        return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
+    # The ClickUp token comes from the working directory's .cursor-tools.env
+    key = ("clickup_task", current_working_directory, task_id)
+    return await run_cached_remote(key, command_args, ctx, structured, priority)
 
 @mcp.tool()
 async def mcp_search(
     query: str,
     provider: Optional[Literal["anthropic", "openrouter"]] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Search the MCP Marketplace for available servers.
     
     Requires ANTHROPIC_API_KEY or OPENROUTER_API_KEY in environment.
@@ -603,15 +2700,17 @@ async def mcp_search(
     path_params = ["save_to"]
     
     command_args = build_command_args(command, params, path_params)
-    return await run_cursor_tools(command_args, ctx)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
 
 @mcp.tool()
 async def mcp_run(
     query: str,
     provider: Optional[Literal["anthropic", "openrouter"]] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Execute MCP server tools using natural language queries.
     
     Requires ANTHROPIC_API_KEY or OPENROUTER_API_KEY in environment.
@@ -624,7 +2723,7 @@ async def mcp_run(
     path_params = ["save_to"]
     
     command_args = build_command_args(command, params, path_params)
-    return await run_cursor_tools(command_args, ctx)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
 
 @mcp.tool()
 async def browser_open(
@@ -641,8 +2740,10 @@ async def browser_open(
     video: Optional[str] = None,
     evaluate: Optional[str] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Open a URL and capture page content, console logs, and network activity.
     
     Part of Stagehand browser automation suite.
@@ -667,7 +2768,7 @@ async def browser_open(
     no_prefix_params = ["console", "network", "headless"]
     
     command_args = build_command_args(command, params, path_params, boolean_params, no_prefix_params)
-    return await run_cursor_tools(command_args, ctx)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
 
 @mcp.tool()
 async def browser_act(
@@ -685,8 +2786,10 @@ async def browser_act(
     video: Optional[str] = None,
     evaluate: Optional[str] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Execute actions on a webpage using natural language instructions.
     
     Supports multi-step workflows using pipe (|) separator.
@@ -712,7 +2815,7 @@ async def browser_act(
     no_prefix_params = ["console", "network", "headless"]
     
     command_args = build_command_args(command, params, path_params, boolean_params, no_prefix_params)
-    return await run_cursor_tools(command_args, ctx)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
 
 @mcp.tool()
 async def browser_observe(
@@ -730,8 +2833,10 @@ async def browser_observe(
     video: Optional[str] = None,
     evaluate: Optional[str] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Observe interactive elements on a webpage and suggest possible actions.
     
     Helps identify actionable elements for browser_act commands.
@@ -757,7 +2862,7 @@ async def browser_observe(
     no_prefix_params = ["console", "network", "headless"]
     
     command_args = build_command_args(command, params, path_params, boolean_params, no_prefix_params)
-    return await run_cursor_tools(command_args, ctx)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
 
 @mcp.tool()
 async def browser_extract(
@@ -775,8 +2880,10 @@ async def browser_extract(
     video: Optional[str] = None,
     evaluate: Optional[str] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Extract data from a webpage based on natural language instructions.
     
     Great for scraping structured information from websites.
@@ -802,15 +2909,115 @@ async def browser_extract(
     no_prefix_params = ["console", "network", "headless"]
     
     command_args = build_command_args(command, params, path_params, boolean_params, no_prefix_params)
-    return await run_cursor_tools(command_args, ctx)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
+
+@mcp.tool()
+async def browser_session(
+    steps: List[Dict[str, str]],
+    url: Optional[str] = None,
+    console: Optional[bool] = None,
+    html: Optional[bool] = None,
+    network: Optional[bool] = None,
+    screenshot: Optional[str] = None,
+    timeout: Optional[int] = None,
+    viewport: Optional[str] = None,
+    headless: Optional[bool] = None,
+    connect_to: Optional[Union[str, int]] = None,
+    wait: Optional[str] = None,
+    video: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
+    ctx: Context = None
+) -> Union[str, Dict[str, Any]]:
+    """Run an ordered list of act/observe/extract/evaluate steps against one page.
+    
+    Each step is {"action": "act" | "observe" | "extract" | "evaluate", "instruction": "..."};
+    for evaluate the instruction is JavaScript, run before the step that follows it.
+    Consecutive act steps run in a single invocation unless screenshot is set, in which case
+    every step gets its own invocation and its own <screenshot>-stepN.<ext>. Later invocations
+    reuse the open page (url "current") of the browser at connect_to, which is therefore
+    required whenever the steps need more than one invocation. Video recordings go to the
+    video directory. Results are streamed step by step and execution stops at the first
+    failing step.
+    """
+    try:
+        invocations = plan_browser_session(steps, merge_acts=not screenshot)
+    except ValueError as e:
+        return render_result(CommandResult(returncode=None, error=f"Error: {e}"), structured)
+    if len(invocations) > 1 and connect_to is None:
+        # Each invocation would launch a fresh browser and reload url, losing earlier steps' effects
+        error = (
+            f"Error: these steps need {len(invocations)} browser invocations, which only share a page "
+            "through connect_to. Start Chrome with --remote-debugging-port and pass its port as connect_to."
+        )
+        return render_result(CommandResult(returncode=None, error=error), structured)
+    
+    start_time = time.time()
+    results: List[Tuple[BrowserInvocation, CommandResult]] = []
+    if ctx:
+        await ctx.report_progress(0, len(steps))
+    for position, invocation in enumerate(invocations):
+        step_url = url
+        if position > 0 and connect_to is not None:
+            step_url = "current"
+        params = {
+            "url": step_url,
+            "console": console,
+            "html": html,
+            "network": network,
+            "screenshot": _numbered_path(screenshot, f"step{invocation.steps[-1]}") if screenshot else None,
+            "timeout": timeout,
+            "viewport": viewport,
+            "headless": headless,
+            "connect_to": connect_to,
+            "wait": wait,
+            "video": video,
+            "evaluate": invocation.evaluate
+        }
+        path_params = ["screenshot", "video"]
+        boolean_params = ["html"]
+        no_prefix_params = ["console", "network", "headless"]
+        
+        command = [cursor_tools_exec, "browser", invocation.action, " | ".join(invocation.instructions)]
+        command_args = build_command_args(command, params, path_params, boolean_params, no_prefix_params)
+        result = await _execute_cursor_tools(command_args, priority=priority)
+        results.append((invocation, result))
+        if ctx:
+            await ctx.info(f"{invocation.label}: {format_result(result)}")
+            await ctx.report_progress(invocation.steps[-1], len(steps))
+        if not result.ok:
+            break
+    
+    completed = sum(len(invocation.steps) for invocation, _ in results)
+    ok = all(result.ok for _, result in results) and completed == len(steps)
+    if structured is None:
+        structured = structured_results_default
+    if structured:
+        return {
+            "ok": ok,
+            "duration_seconds": round(time.time() - start_time, 3),
+            "invocations": len(results),
+            "steps": [
+                dict(result.to_dict(), steps=invocation.steps, action=invocation.action)
+                for invocation, result in results
+            ],
+            "skipped_steps": list(range(completed + 1, len(steps) + 1))
+        }
+    sections = [f"{invocation.label}:\n{format_result(result)}" for invocation, result in results]
+    if completed < len(steps):
+        skipped = f"step {len(steps)}" if completed + 1 == len(steps) else f"steps {completed + 1}-{len(steps)}"
+        sections.append(f"Skipped {skipped} after the failure above.")
+    return "\n\n".join(sections)
 
 @mcp.tool()
 async def xcode_build(
     build_path: Optional[str] = None,
     destination: Optional[str] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Build Xcode project and report errors.
     
     Defaults to iOS Simulator destination if not specified.
@@ -824,14 +3031,16 @@ async def xcode_build(
     path_params = ["build_path", "save_to"]
     
     command_args = build_command_args(command, params, path_params)
-    return await run_cursor_tools(command_args, ctx)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
 
 @mcp.tool()
 async def xcode_run(
     destination: Optional[str] = None,
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Build and run the Xcode project on a simulator.
     
     Defaults to iOS Simulator destination if not specified.
@@ -844,13 +3053,15 @@ async def xcode_run(
     path_params = ["save_to"]
     
     command_args = build_command_args(command, params, path_params)
-    return await run_cursor_tools(command_args, ctx)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
 
 @mcp.tool()
 async def xcode_lint(
     save_to: Optional[str] = None,
+    structured: Optional[bool] = None,
+    priority: Optional[str] = None,
     ctx: Context = None
-) -> str:
+) -> Union[str, Dict[str, Any]]:
     """Run static analysis on the Xcode project to find and fix issues."""
     command = [cursor_tools_exec, "xcode", "lint"]
     params = {
@@ -859,11 +3070,50 @@ async def xcode_lint(
     path_params = ["save_to"]
     
     command_args = build_command_args(command, params, path_params)
-    return await run_cursor_tools(command_args, ctx)
+    return await run_cursor_tools(command_args, ctx, structured=structured, priority=priority)
+
+@mcp.tool()
+async def server_metrics() -> Dict[str, Any]:
+    """Report per-command call counts, durations, child CPU time and peak RSS since startup.
+    
+    Useful for sizing VIBE_TOOLS_MAX_CONCURRENCY and the child resource limits.
+    """
+    return {
+        "commands": {command: metrics.to_dict() for command, metrics in sorted(_command_metrics.items())},
+        "scheduler": _scheduler.to_dict(),
+        "child_limits": asdict(child_limits)
+    }
+
+@mcp.tool()
+async def invocation_stats(tool: Optional[str] = None, since_hours: Optional[float] = None, top: int = 10) -> Dict[str, Any]:
+    """Aggregate the invocation log: the slowest calls, per-tool p50/p95 duration and error
+    rates, and error rates by provider.
+    
+    Parameters:
+    - tool: Only count one tool, e.g. "repo" or "github pr"
+    - since_hours: Only count calls from the last N hours
+    - top: How many of the slowest calls to list
+    """
+    since = time.time() - since_hours * 3600 if since_hours else None
+    return await asyncio.to_thread(aggregate_invocations, tool, since, max(0, top))
 
 def main():
     """Entry point for the package."""
-    mcp.run()
+    global _probe
+    _probe = probe_executable(cursor_tools_exec)
+    if _probe.path is None:
+        logger.warning("%s not found on PATH; tools will fail until it is installed", cursor_tools_exec)
+    else:
+        logger.info(
+            "Resolved %s to %s (version %s, commands: %s)",
+            cursor_tools_exec, _probe.path, _probe.version, ", ".join(_probe.subcommands) or "unknown"
+        )
+    # stdio by default; sse serves many client sessions from one process (FASTMCP_HOST/FASTMCP_PORT)
+    transport = os.environ.get('VIBE_TOOLS_MCP_TRANSPORT', 'stdio').lower()
+    if transport not in ('stdio', 'sse'):
+        logger.warning("Unknown VIBE_TOOLS_MCP_TRANSPORT %r, using stdio", transport)
+        transport = 'stdio'
+    mcp.run(transport=transport)
 
 if __name__ == "__main__":
     main()
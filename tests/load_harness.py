@@ -0,0 +1,363 @@
+"""Concurrent load test that speaks MCP to the real server.
+
+Launches ``server.main()`` as a subprocess on the SSE transport, pointed at a fake
+vibe-tools, opens many client sessions and replays a weighted mix of tool calls. Reports
+throughput, per-tool latency percentiles, event-loop lag and the server's RSS over time.
+
+Event-loop lag is measured from a dedicated session that calls the ``test`` echo tool at
+a fixed interval: the echo does no work, so its round trip is dispatch plus however long
+the server's loop was busy elsewhere.
+
+    python tests/load_harness.py --sessions 20 --calls 50 --mix ask=4,repo=1,github_issue=2,test=3
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import pathlib
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from mcp import ClientSession
+from mcp.client.sse import sse_client
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# Answers the startup probe like vibe-tools, then sleeps and prints a fixed-size payload
+FAKE_VIBE_TOOLS = """#!/bin/sh
+case "$1" in
+  --version) echo "0.60.0"; exit 0 ;;
+  --help) echo "Commands: ask plan web repo doc youtube github clickup mcp browser xcode"; exit 0 ;;
+esac
+sleep {delay}
+head -c {output_bytes} /dev/zero | tr '\\0' 'x'
+echo
+exit {exit_code}
+"""
+
+# Arguments for each tool the mix can name; the argument is the call's sequence number
+TOOL_ARGUMENTS: Dict[str, Callable[[int], Dict[str, Any]]] = {
+    "test": lambda i: {"message": f"ping {i}"},
+    "ask": lambda i: {"query": f"load test question {i}", "provider": "openai", "model": "gpt-4o"},
+    "plan": lambda i: {"query": f"plan change {i}"},
+    "web": lambda i: {"query": f"search {i}"},
+    "repo": lambda i: {"query": f"explain module {i}"},
+    "doc": lambda i: {},
+    "github_pr": lambda i: {"number": i % 5 + 1},
+    "github_issue": lambda i: {"number": i % 5 + 1},
+    "server_metrics": lambda i: {},
+}
+
+# Tools that run vibe-tools; they are called with structured=True so a failed run is visible
+# as ok == false rather than only in the text (isError is set only when a tool raises)
+STRUCTURED_TOOLS = {"ask", "plan", "web", "repo", "doc", "github_pr", "github_issue"}
+
+@dataclass
+class LoadOptions:
+    sessions: int = 10
+    # Calls per session, issued one after another
+    calls: int = 20
+    mix: List[Tuple[str, int]] = field(default_factory=lambda: [("ask", 4), ("repo", 1), ("github_issue", 2), ("test", 3)])
+    # Fake vibe-tools behaviour
+    fake_delay: float = 0.2
+    fake_output_bytes: int = 2048
+    fake_exit_code: int = 0
+    # Interval for the event-loop lag probe and RSS sampling
+    sample_interval: float = 0.25
+    # Extra server environment, e.g. VIBE_TOOLS_MAX_CONCURRENCY
+    server_env: Dict[str, str] = field(default_factory=dict)
+    seed: int = 0
+    workdir: Optional[pathlib.Path] = None
+    startup_timeout: float = 20.0
+
+def parse_mix(spec: str) -> List[Tuple[str, int]]:
+    """Parse "ask=4,repo=1" into weighted tool names."""
+    mix = []
+    for part in spec.split(","):
+        name, _, weight = part.strip().partition("=")
+        if name not in TOOL_ARGUMENTS:
+            raise ValueError(f"Unknown tool '{name}' in mix; choose from {', '.join(sorted(TOOL_ARGUMENTS))}")
+        mix.append((name, int(weight or 1)))
+    return mix
+
+def percentile(values: List[float], q: float) -> float:
+    """Linear-interpolated quantile, 0.0 for no values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = q * (len(ordered) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def read_rss_kb(pid: int) -> Optional[int]:
+    """Resident set size of pid in KiB, from /proc where available and ps elsewhere."""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    try:
+        output = subprocess.run(["ps", "-o", "rss=", "-p", str(pid)], capture_output=True, text=True).stdout
+        return int(output.strip())
+    except (OSError, ValueError):
+        return None
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_server(workdir: pathlib.Path, options: LoadOptions, port: int) -> subprocess.Popen:
+    """Start server.main() on the SSE transport against a fake vibe-tools in workdir."""
+    fake = workdir / "vibe-tools"
+    fake.write_text(FAKE_VIBE_TOOLS.format(
+        delay=options.fake_delay,
+        output_bytes=options.fake_output_bytes,
+        exit_code=options.fake_exit_code
+    ))
+    fake.chmod(0o755)
+    env = dict(os.environ)
+    env.update({
+        "VIBE_TOOLS_PATH": str(fake),
+        "VIBE_TOOLS_MCP_TRANSPORT": "sse",
+        "VIBE_TOOLS_MCP_CACHE_DIR": str(workdir / "cache"),
+        "FASTMCP_HOST": "127.0.0.1",
+        "FASTMCP_PORT": str(port),
+        "FASTMCP_LOG_LEVEL": "WARNING",
+    })
+    env.update(options.server_env)
+    with open(workdir / "server.log", "wb") as log:
+        return subprocess.Popen(
+            [sys.executable, "-c", "import server; server.main()"],
+            cwd=REPO_ROOT,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=log,
+        )
+
+def stop_server(process: subprocess.Popen) -> None:
+    """Terminate the server, killing it if open SSE streams hold up uvicorn's graceful shutdown."""
+    process.terminate()
+    try:
+        process.wait(timeout=1)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+async def wait_until_listening(process: subprocess.Popen, port: int, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode} during startup")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError(f"Server did not listen on port {port} within {timeout}s")
+
+async def _open_session(stack, url: str) -> ClientSession:
+    read, write = await stack.enter_async_context(sse_client(url, timeout=30, sse_read_timeout=600))
+    session = await stack.enter_async_context(ClientSession(read, write))
+    await session.initialize()
+    return session
+
+def tool_arguments(tool: str, call: int) -> Dict[str, Any]:
+    arguments = TOOL_ARGUMENTS[tool](call)
+    if tool in STRUCTURED_TOOLS:
+        arguments["structured"] = True
+    return arguments
+
+def call_failed(tool: str, result: Any) -> bool:
+    """A call failed if the tool raised, or a structured tool reported ok == false or did not answer in JSON."""
+    if result.isError:
+        return True
+    if tool not in STRUCTURED_TOOLS:
+        return False
+    text = result.content[0].text if result.content and hasattr(result.content[0], "text") else ""
+    try:
+        payload = json.loads(text)
+    except ValueError:
+        return True
+    return not isinstance(payload, dict) or payload.get("ok") is False
+
+async def run_session(
+    url: str,
+    index: int,
+    options: LoadOptions,
+    workdir: pathlib.Path,
+    latencies: Dict[str, List[float]],
+    errors: Dict[str, int]
+) -> None:
+    """One client: set the working directory, then issue its calls back to back."""
+    rng = random.Random(options.seed + index)
+    names = [name for name, _ in options.mix]
+    weights = [weight for _, weight in options.mix]
+    async with contextlib.AsyncExitStack() as stack:
+        session = await _open_session(stack, url)
+        await session.call_tool("set_working_directory", {"directory_path": str(workdir)})
+        for call in range(options.calls):
+            tool = rng.choices(names, weights)[0]
+            started = time.perf_counter()
+            try:
+                result = await session.call_tool(tool, tool_arguments(tool, index * options.calls + call))
+                failed = call_failed(tool, result)
+            except Exception:
+                failed = True
+            latencies.setdefault(tool, []).append(time.perf_counter() - started)
+            if failed:
+                errors[tool] = errors.get(tool, 0) + 1
+
+async def probe_loop_lag(url: str, interval: float, stop: asyncio.Event, samples: List[float]) -> None:
+    """Round-trip the echo tool every interval until stop is set."""
+    async with contextlib.AsyncExitStack() as stack:
+        session = await _open_session(stack, url)
+        while not stop.is_set():
+            started = time.perf_counter()
+            await session.call_tool("test", {"message": "lag"})
+            samples.append(time.perf_counter() - started)
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stop.wait(), interval)
+
+async def sample_rss(pid: int, interval: float, stop: asyncio.Event, started: float, samples: List[Tuple[float, int]]) -> None:
+    """Record (elapsed seconds, RSS KiB) every interval until stop is set."""
+    while True:
+        rss = await asyncio.to_thread(read_rss_kb, pid)
+        if rss is not None:
+            samples.append((round(time.perf_counter() - started, 2), rss))
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+            return
+        except asyncio.TimeoutError:
+            continue
+
+async def run_load(options: LoadOptions) -> Dict[str, Any]:
+    """Start the server, drive it with options.sessions concurrent clients and return a report."""
+    with tempfile.TemporaryDirectory() as scratch:
+        workdir = options.workdir or pathlib.Path(scratch)
+        port = _free_port()
+        process = start_server(workdir, options, port)
+        try:
+            await wait_until_listening(process, port, options.startup_timeout)
+            url = f"http://127.0.0.1:{port}/sse"
+            latencies: Dict[str, List[float]] = {}
+            errors: Dict[str, int] = {}
+            lag: List[float] = []
+            rss: List[Tuple[float, int]] = []
+            stop = asyncio.Event()
+            started = time.perf_counter()
+            monitors = [
+                asyncio.create_task(probe_loop_lag(url, options.sample_interval, stop, lag)),
+                asyncio.create_task(sample_rss(process.pid, options.sample_interval, stop, started, rss)),
+            ]
+            try:
+                await asyncio.gather(*(
+                    run_session(url, index, options, workdir, latencies, errors)
+                    for index in range(options.sessions)
+                ))
+            finally:
+                elapsed = time.perf_counter() - started
+                stop.set()
+                await asyncio.gather(*monitors, return_exceptions=True)
+        finally:
+            stop_server(process)
+
+    total_calls = sum(len(values) for values in latencies.values())
+    every_latency = [value for values in latencies.values() for value in values]
+
+    def summary(values: List[float]) -> Dict[str, float]:
+        return {
+            "p50_ms": round(percentile(values, 0.5) * 1000, 1),
+            "p95_ms": round(percentile(values, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(values, 0.99) * 1000, 1),
+            "max_ms": round(max(values, default=0.0) * 1000, 1),
+        }
+
+    return {
+        "sessions": options.sessions,
+        "calls": total_calls,
+        "errors": sum(errors.values()),
+        "duration_seconds": round(elapsed, 2),
+        "throughput_per_second": round(total_calls / elapsed, 2) if elapsed else 0.0,
+        "latency": summary(every_latency),
+        "tools": {
+            tool: {"calls": len(values), "errors": errors.get(tool, 0), **summary(values)}
+            for tool, values in sorted(latencies.items())
+        },
+        "event_loop_lag": {"samples": len(lag), **summary(lag)},
+        "rss_kb": {
+            "start": rss[0][1] if rss else None,
+            "peak": max((value for _, value in rss), default=None),
+            "end": rss[-1][1] if rss else None,
+            "timeline": rss,
+        },
+    }
+
+def format_report(report: Dict[str, Any]) -> str:
+    lines = [
+        f"{report['calls']} calls from {report['sessions']} sessions in {report['duration_seconds']}s "
+        f"({report['throughput_per_second']}/s), {report['errors']} errors",
+        "",
+        f"{'tool':<16}{'calls':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}",
+    ]
+    rows = list(report["tools"].items()) + [("all", {"calls": report["calls"], "errors": report["errors"], **report["latency"]})]
+    for tool, stats in rows:
+        lines.append(
+            f"{tool:<16}{stats['calls']:>7}{stats['errors']:>8}{stats['p50_ms']:>10}"
+            f"{stats['p95_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}"
+        )
+    lag = report["event_loop_lag"]
+    lines += [
+        "",
+        f"event-loop lag (echo round trip, {lag['samples']} samples): "
+        f"p50 {lag['p50_ms']}ms, p95 {lag['p95_ms']}ms, max {lag['max_ms']}ms",
+    ]
+    rss = report["rss_kb"]
+    if rss["timeline"]:
+        lines.append(f"server RSS: start {rss['start']} KiB, peak {rss['peak']} KiB, end {rss['end']} KiB")
+        step = max(1, len(rss["timeline"]) // 10)
+        lines.append("  " + ", ".join(f"{elapsed}s={value}" for elapsed, value in rss["timeline"][::step]))
+    return "\n".join(lines)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=10, help="Concurrent MCP client sessions")
+    parser.add_argument("--calls", type=int, default=20, help="Calls per session")
+    parser.add_argument("--mix", default="ask=4,repo=1,github_issue=2,test=3", help="Weighted tools, e.g. ask=4,repo=1")
+    parser.add_argument("--fake-delay", type=float, default=0.2, help="Seconds each fake vibe-tools call sleeps")
+    parser.add_argument("--fake-output-bytes", type=int, default=2048, help="Bytes each fake vibe-tools call prints")
+    parser.add_argument("--fake-exit-code", type=int, default=0, help="Exit code of each fake vibe-tools call")
+    parser.add_argument("--sample-interval", type=float, default=0.25, help="Seconds between lag probes and RSS samples")
+    parser.add_argument("--server-env", action="append", default=[], metavar="KEY=VALUE", help="Extra server environment")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    options = LoadOptions(
+        sessions=args.sessions,
+        calls=args.calls,
+        mix=parse_mix(args.mix),
+        fake_delay=args.fake_delay,
+        fake_output_bytes=args.fake_output_bytes,
+        fake_exit_code=args.fake_exit_code,
+        sample_interval=args.sample_interval,
+        server_env=dict(item.split("=", 1) for item in args.server_env),
+        seed=args.seed,
+    )
+    report = asyncio.run(run_load(options))
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+    return 1 if report["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+import pytest
+
+from tests import load_harness
+
+def test_parse_mix_rejects_unknown_tools():
+    assert load_harness.parse_mix("ask=3, test") == [("ask", 3), ("test", 1)]
+    with pytest.raises(ValueError):
+        load_harness.parse_mix("nope=1")
+
+@pytest.mark.asyncio
+async def test_harness_drives_the_real_server_concurrently(tmp_path):
+    options = load_harness.LoadOptions(
+        sessions=3,
+        calls=4,
+        mix=[("ask", 1), ("github_issue", 1), ("test", 1)],
+        fake_delay=0.05,
+        fake_output_bytes=64,
+        sample_interval=0.1,
+        workdir=tmp_path
+    )
+
+    report = await load_harness.run_load(options)
+
+    assert report["calls"] == 12
+    assert report["errors"] == 0
+    assert report["throughput_per_second"] > 0
+    assert report["event_loop_lag"]["samples"] >= 1
+    assert report["rss_kb"]["peak"] > 0
+    # Calls reached the fake vibe-tools through real dispatch
+    assert "ask" in (tmp_path / "cache" / "invocations.jsonl").read_text()
+
+@pytest.mark.asyncio
+async def test_harness_counts_failed_runs_as_errors(tmp_path):
+    options = load_harness.LoadOptions(
+        sessions=1,
+        calls=3,
+        mix=[("github_issue", 1)],
+        fake_delay=0,
+        fake_output_bytes=16,
+        fake_exit_code=1,
+        sample_interval=0.1,
+        workdir=tmp_path
+    )
+
+    report = await load_harness.run_load(options)
+
+    assert report["calls"] == 3
+    assert report["errors"] == 3
+    assert report["tools"]["github_issue"]["errors"] == 3
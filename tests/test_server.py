@@ -1,13 +1,22 @@
+import asyncio
+import json
+import logging
+import os
 import pytest
+import sys
+import time
 from unittest.mock import patch, AsyncMock
 
 import server
 
 @pytest.fixture(autouse=True)
-def patch_globals(monkeypatch):
+def patch_globals(monkeypatch, tmp_path):
     # Patch current_working_directory and cursor_tools_exec globally
     monkeypatch.setattr(server, "current_working_directory", "/cwd")
     monkeypatch.setattr(server, "cursor_tools_exec", "cursor-tools")
+    # Keep on-disk server state out of the user's cache directory
+    monkeypatch.setenv("VIBE_TOOLS_MCP_CACHE_DIR", str(tmp_path / "mcp-cache"))
+    monkeypatch.setattr(server, "_duration_stats", None)
 
 def test_boolean_flags():
     base_cmd = ["cursor-tools", "cmd"]
@@ -131,4 +140,980 @@ async def test_ask_builds_command_and_calls_run_cursor_tools():
         assert "--max-tokens=100" in called_args
         assert "--provider=openai" in called_args
         assert "--model=gpt-4" in called_args
-        assert "--reasoning-effort=high" in called_args
\ No newline at end of file
+        assert "--reasoning-effort=high" in called_args
+
+def test_plan_shards_splits_largest_directories():
+    sizes = {
+        "README.md": 10,
+        "packages/a/index.js": 500,
+        "packages/a/lib/util.js": 500,
+        "packages/b/index.js": 600,
+        "packages/c/index.js": 100,
+        "docs/guide.md": 50
+    }
+
+    plan = server.plan_shards(sizes, 4)
+
+    # packages is split into its children, docs stays whole, nothing exceeds the cap
+    assert plan == ["packages/a", "packages/b", "packages/c", "docs"]
+    # Files directly inside the split root are reported so the combine step can include them
+    assert server.uncovered_files(sizes, plan) == ["README.md"]
+    assert server.plan_shards(sizes, 1) == [""]
+    assert server.uncovered_files(sizes, [""]) == []
+
+def test_plan_shards_keeps_directories_with_many_loose_files():
+    sizes = {
+        "main.py": 1000,
+        "pkg/mod.py": 500,
+        "tests/test_mod.py": 500
+    }
+
+    # The root holds half the bytes directly, splitting it would drop main.py
+    assert server.plan_shards(sizes, 4) == [""]
+
+@pytest.mark.asyncio
+async def test_repo_sharded_runs_each_shard_and_combines(tmp_path, monkeypatch):
+    root = tmp_path / "repo"
+    (root / "a").mkdir(parents=True)
+    (root / "a" / "x.py").write_text("x" * 100)
+    (root / "b").mkdir()
+    (root / "b" / "y.py").write_text("y" * 100)
+    (root / "README.md").write_text("readme")
+    log = tmp_path / "calls.log"
+    stub = tmp_path / "stub.sh"
+    stub.write_text(f'#!/bin/sh\necho "$@" >> {log}\necho "answer for $2"\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(root))
+    monkeypatch.setattr(server, "cursor_tools_exec", str(stub))
+
+    result = await server.repo(query="what is here", shards=2)
+
+    calls = log.read_text().splitlines()
+    assert sum(call.startswith("repo ") for call in calls) == 2
+    assert any(f"--subdir={root / 'a'}" in call for call in calls)
+    assert any(f"--subdir={root / 'b'}" in call for call in calls)
+    assert sum(call.startswith("ask ") for call in calls) == 1
+    # The root README sits in no shard, so its contents go to the combining call
+    assert "### README.md\nreadme" in log.read_text()
+    assert result.startswith("Command successful:")
+
+@pytest.mark.asyncio
+async def test_doc_shards_run_in_their_subtrees(tmp_path, monkeypatch):
+    root = tmp_path / "repo"
+    (root / "a").mkdir(parents=True)
+    (root / "a" / "x.py").write_text("x" * 100)
+    (root / "b").mkdir()
+    (root / "b" / "y.py").write_text("y" * 100)
+    log = tmp_path / "calls.log"
+    stub = tmp_path / "stub.sh"
+    stub.write_text(f'#!/bin/sh\necho "$1 $(pwd) $2" >> {log}\necho "docs"\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(root))
+    monkeypatch.setattr(server, "cursor_tools_exec", str(stub))
+
+    await server.doc(shards=2)
+
+    doc_calls = sorted(call for call in log.read_text().splitlines() if call.startswith("doc "))
+    # doc has no --subdir, so each shard runs with its subtree as the working directory
+    assert doc_calls == [f"doc {root / 'a'} ", f"doc {root / 'b'} "]
+
+@pytest.mark.asyncio
+async def test_sharded_call_on_unsplittable_tree_skips_combining(tmp_path, monkeypatch):
+    root = tmp_path / "repo"
+    root.mkdir()
+    (root / "main.py").write_text("x" * 100)
+    log = tmp_path / "calls.log"
+    stub = tmp_path / "stub.sh"
+    stub.write_text(f'#!/bin/sh\necho "$1" >> {log}\necho "answer"\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(root))
+    monkeypatch.setattr(server, "cursor_tools_exec", str(stub))
+
+    result = await server.repo(query="what is here", shards=4)
+
+    assert log.read_text().splitlines() == ["repo"]
+    assert result == "Command successful:\nanswer"
+
+@pytest.mark.asyncio
+async def test_sharded_combining_query_fits_one_argument(tmp_path, monkeypatch):
+    root = tmp_path / "repo"
+    for i in range(20):
+        (root / f"group{i % 2}" / f"pkg{i:02}").mkdir(parents=True)
+        (root / f"group{i % 2}" / f"pkg{i:02}" / "mod.py").write_text("x" * 10000)
+    # Loose binary files no shard covers; far too many names to list in full
+    for i in range(200):
+        (root / f"loose_binary_file_with_a_long_name_{i:03}.bin").write_bytes(b"\xff\xfe")
+    log = tmp_path / "calls.log"
+    stub = tmp_path / "stub.py"
+    stub.write_text(
+        f"#!{sys.executable}\n"
+        "import sys\n"
+        f"with open({str(log)!r}, 'a') as f:\n"
+        "    f.write(f'{sys.argv[1]} {len(sys.argv[2].encode())}\\n')\n"
+        "print('\u00e9' * 60000 if sys.argv[1] == 'repo' else 'combined')\n"
+    )
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(root))
+    monkeypatch.setattr(server, "cursor_tools_exec", str(stub))
+
+    result = await server.repo(query="what is here", shards=200)
+
+    calls = [line.split() for line in log.read_text().splitlines()]
+    # Shard count is capped, and the multibyte answers are cut by bytes, not characters
+    assert 1 < sum(name == "repo" for name, _ in calls) <= server.SHARD_MAX_COUNT
+    [combine_bytes] = [int(size) for name, size in calls if name == "ask"]
+    assert server.SHARD_COMBINE_MAX_BYTES - 1024 < combine_bytes <= server.SHARD_COMBINE_MAX_BYTES
+    assert result == "Command successful:\ncombined"
+
+def test_uncovered_files_section_bounds_omitted_names(tmp_path):
+    paths = [f"loose_binary_file_with_a_long_name_{i:03}.bin" for i in range(200)]
+    for path in paths:
+        (tmp_path / path).write_bytes(b"\xff\xfe")
+
+    section = server._uncovered_files_section(str(tmp_path), paths)
+
+    assert len(section.encode()) < server.SHARD_UNCOVERED_NAMES_MAX_BYTES + 64
+    assert section.endswith("more")
+    assert paths[0] in section and paths[-1] not in section
+
+@pytest.mark.asyncio
+async def test_repo_with_repo_url_is_never_sharded(tmp_path, monkeypatch):
+    root = tmp_path / "repo"
+    (root / "a").mkdir(parents=True)
+    (root / "a" / "x.py").write_text("x" * 100)
+    (root / "b").mkdir()
+    (root / "b" / "y.py").write_text("y" * 100)
+    log = tmp_path / "calls.log"
+    stub = tmp_path / "stub.sh"
+    stub.write_text(f'#!/bin/sh\necho "$@" >> {log}\necho "answer"\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(root))
+    monkeypatch.setattr(server, "cursor_tools_exec", str(stub))
+
+    await server.repo(query="what is here", repo_url="https://github.com/o/r", shards=2)
+
+    # The question is about the remote repository, not the local tree
+    assert log.read_text().splitlines() == ["repo what is here --repo-url=https://github.com/o/r"]
+
+def test_is_ignored_patterns():
+    patterns = [("*.log", False, False), ("build", True, False), ("docs/generated", False, True)]
+
+    assert server.is_ignored("logs/app.log", False, patterns)
+    assert server.is_ignored("src/build", True, patterns)
+    assert not server.is_ignored("src/build", False, patterns)
+    assert server.is_ignored("docs/generated", True, patterns)
+    assert not server.is_ignored("other/docs/generated", True, patterns)
+    assert not server.is_ignored("src/main.py", False, patterns)
+
+def test_context_index_updates_incrementally(tmp_path):
+    root = tmp_path / "repo"
+    root.mkdir()
+    (root / ".gitignore").write_text("*.log\n")
+    (root / "a.py").write_text("print('a')\n")
+    (root / "b.py").write_text("print('b')\n")
+    (root / "debug.log").write_text("noise\n")
+
+    index = server.update_context_index(str(root))
+    assert sorted(index.files) == [".gitignore", "a.py", "b.py"]
+    unchanged = index.files[".gitignore"]
+
+    (root / "b.py").write_text("print('changed b')\n")
+    os.utime(root / "b.py", ns=(1, 1))
+    (root / "a.py").unlink()
+    index = server.update_context_index(str(root))
+
+    # Unchanged entries are kept, the modified file is restated, deleted files drop out
+    assert index.files[".gitignore"] is unchanged
+    assert index.files["b.py"].mtime_ns == 1
+    assert index.files["b.py"].size == len("print('changed b')\n")
+    assert sorted(index.files) == [".gitignore", "b.py"]
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.02)
+    return False
+
+@pytest.mark.parametrize("backend", ["inotify", "polling"])
+def test_watcher_collects_dirty_paths(tmp_path, backend):
+    if backend == "inotify" and not sys.platform.startswith("linux"):
+        pytest.skip("inotify is Linux only")
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "a.py").write_text("a")
+    settled = []
+    watcher = server.DirectoryWatcher(
+        str(tmp_path), on_settled=lambda w, structural: settled.append(structural),
+        backend=backend, debounce=0.05, poll_interval=0.05
+    )
+    watcher.start()
+    try:
+        assert _wait_for(lambda: watcher.ready)
+        # First drain registers the consumer and asks for a full rescan
+        assert watcher.drain("test").full_rescan
+        generation = watcher.structure_generation
+
+        (tmp_path / "src" / "a.py").write_text("changed")
+        (tmp_path / "src" / "b.py").write_text("new")
+
+        assert _wait_for(lambda: settled)
+        changes = watcher.drain("test")
+        assert not changes.full_rescan
+        assert {"src/a.py", "src/b.py"} <= changes.paths
+        assert watcher.structure_generation > generation
+        assert watcher.drain("test").paths == set()
+    finally:
+        watcher.stop()
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_context_index_refreshes_only_watched_paths(tmp_path, monkeypatch):
+    root = tmp_path / "repo"
+    (root / "pkg").mkdir(parents=True)
+    (root / "pkg" / "a.py").write_text("a = 1\n")
+    (root / "pkg" / "b.py").write_text("b = 1\n")
+    watcher = server.DirectoryWatcher(str(root), backend="inotify", debounce=0.05)
+    monkeypatch.setitem(server._watchers, str(root), watcher)
+    watcher.start()
+    try:
+        assert _wait_for(lambda: watcher.ready)
+        server.update_context_index(str(root))
+
+        (root / "pkg" / "a.py").write_text("a = 22\n")
+        (root / "pkg" / "b.py").unlink()
+        assert _wait_for(lambda: len(watcher._consumers["context_index"].paths) >= 2)
+
+        # No tree walk: the dirty-set alone drives the update
+        with patch("server._iter_tree", side_effect=AssertionError("tree walked")):
+            index = server.update_context_index(str(root))
+        assert sorted(index.files) == ["pkg/a.py"]
+        assert index.files["pkg/a.py"].size == len("a = 22\n")
+    finally:
+        watcher.stop()
+
+@pytest.fixture
+def counting_stub(tmp_path, monkeypatch):
+    """Fake vibe-tools that numbers its invocations."""
+    counter = tmp_path / "count"
+    stub = tmp_path / "counting-stub.sh"
+    stub.write_text(
+        f'#!/bin/sh\nn=$(( $(cat {counter} 2>/dev/null || echo 0) + 1 ))\n'
+        f'echo $n > {counter}\necho "fetch $n: $*"\n'
+    )
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "cursor_tools_exec", str(stub))
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+    monkeypatch.setattr(server, "_remote_cache", {})
+    monkeypatch.setattr(server, "_remote_fetches", {})
+    return lambda: int(counter.read_text()) if counter.exists() else 0
+
+@pytest.mark.asyncio
+async def test_remote_cache_serves_repeat_calls(counting_stub):
+    first = await server.github_pr(number=7)
+    second = await server.github_pr(number=7)
+    other = await server.github_issue(number=7)
+
+    assert first == second
+    assert "fetch 1: github pr 7" in first
+    assert "github issue 7" in other
+    assert counting_stub() == 2
+
+@pytest.mark.asyncio
+async def test_remote_cache_miss_streams_to_the_caller(counting_stub):
+    ctx = AsyncMock()
+
+    await server.github_pr(number=7, ctx=ctx)
+    await server.github_pr(number=7, ctx=ctx)
+
+    messages = [call.args[0] for call in ctx.info.call_args_list]
+    # The miss streams its output and progress; the hit only says where it came from
+    assert "OUT: fetch 1: github pr 7" in messages
+    assert ctx.report_progress.await_count >= 2
+    assert messages[-1].startswith("Served from cache")
+
+@pytest.mark.asyncio
+async def test_remote_cache_revalidates_stale_entries_in_background(counting_stub, monkeypatch):
+    monkeypatch.setattr(server, "REMOTE_CACHE_SOFT_TTL", 0)
+
+    first = await server.clickup_task(task_id="abc")
+    stale = await server.clickup_task(task_id="abc")
+
+    # The stale answer comes back immediately while a refresh runs
+    assert stale == first
+    await asyncio.gather(*server._remote_fetches.values())
+    assert counting_stub() == 2
+    assert "fetch 2" in await server.clickup_task(task_id="abc")
+
+@pytest.mark.asyncio
+async def test_failed_background_revalidation_is_logged(counting_stub, monkeypatch):
+    monkeypatch.setattr(server, "REMOTE_CACHE_SOFT_TTL", 0)
+    first = await server.clickup_task(task_id="abc")
+    handler = _ListHandler()
+    server.logger.addHandler(handler)
+    try:
+        with patch("server._execute_cursor_tools", side_effect=RuntimeError("boom")):
+            assert await server.clickup_task(task_id="abc") == first
+            task = next(iter(server._remote_fetches.values()))
+            await asyncio.gather(task, return_exceptions=True)
+    finally:
+        server.logger.removeHandler(handler)
+
+    assert handler.messages == ["Remote fetch failed: boom"]
+
+@pytest.mark.asyncio
+async def test_remote_cache_refetches_past_hard_ttl(counting_stub, monkeypatch):
+    await server.github_issue()
+    monkeypatch.setattr(server, "REMOTE_CACHE_HARD_TTL", 0.01)
+    time.sleep(0.02)
+
+    assert "fetch 2" in await server.github_issue()
+
+@pytest.mark.asyncio
+async def test_set_working_directory_prefetches_remote_lists(counting_stub, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "prefetch_enabled", True)
+    (tmp_path / "project" / ".git").mkdir(parents=True)
+
+    await server.set_working_directory("project")
+    await server._prefetch_task
+
+    assert counting_stub() == 2
+    # Served from the warmed cache without spawning anything
+    assert "github pr" in await server.github_pr()
+    assert "github issue" in await server.github_issue()
+    assert counting_stub() == 2
+
+@pytest.mark.asyncio
+async def test_prefetch_cancelled_when_directory_changes_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+    monkeypatch.setattr(server, "prefetch_enabled", True)
+    (tmp_path / "one").mkdir()
+    (tmp_path / "two").mkdir()
+    started = []
+
+    async def slow_prefetch(root):
+        started.append(root)
+        await asyncio.sleep(10)
+
+    monkeypatch.setattr(server, "prefetch_working_directory", slow_prefetch)
+    await server.set_working_directory("one")
+    first = server._prefetch_task
+    await asyncio.sleep(0)
+    await server.set_working_directory(str(tmp_path / "two"))
+    await asyncio.sleep(0)
+
+    assert first.cancelled()
+    assert started == [str(tmp_path / "one"), str(tmp_path / "two")]
+    server._prefetch_task.cancel()
+
+@pytest.mark.asyncio
+async def test_cancelling_a_call_does_not_block_on_a_stubborn_child(tmp_path, monkeypatch):
+    pid_file = tmp_path / "child.pid"
+    stub = tmp_path / "stub.sh"
+    stub.write_text(f"#!/bin/sh\ntrap '' TERM\necho $$ > {pid_file}\nsleep 5\n")
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+    monkeypatch.setattr(server, "CHILD_TERMINATE_GRACE_SECONDS", 0.5)
+    task = asyncio.create_task(server.run_cursor_tools([str(stub), "ask"]))
+    while not pid_file.exists() or not pid_file.read_text().strip():
+        await asyncio.sleep(0.02)
+    pid = int(pid_file.read_text())
+
+    started = time.monotonic()
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    # The child ignores SIGTERM; waiting for it, then killing it, happens off the event loop
+    assert time.monotonic() - started < 0.3
+    def child_gone():
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        return False
+    await asyncio.sleep(0.6)
+    assert _wait_for(child_gone)
+
+@pytest.fixture
+def probe_stub(tmp_path):
+    """Fake vibe-tools that answers --version/--help and counts every invocation."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    counter = tmp_path / "probe-count"
+    stub = bin_dir / "vibe-tools"
+    stub.write_text(
+        f'#!/bin/sh\necho x >> {counter}\n'
+        'case "$1" in\n'
+        '  --version) echo "0.60.1" ;;\n'
+        '  --help) echo "Commands:"; echo "  ask <question> [--provider=<p>]"; echo "  repo <question> [--subdir=<dir>]" ;;\n'
+        '  *) echo "ran $*" ;;\n'
+        'esac\n'
+    )
+    stub.chmod(0o755)
+    return bin_dir, lambda: len(counter.read_text().splitlines()) if counter.exists() else 0
+
+def test_probe_executable_resolves_and_caches(probe_stub, monkeypatch):
+    bin_dir, calls = probe_stub
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    probe = server.probe_executable("vibe-tools")
+
+    assert probe.path == str(bin_dir / "vibe-tools")
+    assert probe.version == "0.60.1"
+    assert probe.subcommands == ["ask", "repo"]
+    assert "--subdir" in probe.flags
+    assert calls() == 2
+
+    # Second probe is served from the on-disk cache until the binary changes
+    assert server.probe_executable("vibe-tools") == probe
+    assert calls() == 2
+    os.utime(bin_dir / "vibe-tools", ns=(1, 1))
+    server.probe_executable("vibe-tools")
+    assert calls() == 4
+
+    assert server.probe_executable("no-such-vibe-tools").path is None
+
+@pytest.mark.asyncio
+async def test_probe_rejects_unsupported_commands_without_spawning(probe_stub, monkeypatch, tmp_path):
+    bin_dir, calls = probe_stub
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setattr(server, "cursor_tools_exec", "vibe-tools")
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+    monkeypatch.setattr(server, "_probe", server.probe_executable("vibe-tools"))
+    probed = calls()
+
+    assert "does not support the 'clickup' command" in await server.run_cursor_tools(["vibe-tools", "clickup", "task", "1"])
+    assert calls() == probed
+    assert await server.run_cursor_tools(["vibe-tools", "ask", "hi"]) == "Command successful:\nran ask hi"
+
+    monkeypatch.setattr(server, "_probe", server.ExecutableProbe(requested="vibe-tools", path=None))
+    assert await server.run_cursor_tools(["vibe-tools", "ask", "hi"]) == server.EXECUTABLE_NOT_FOUND_ERROR
+
+@pytest.mark.asyncio
+async def test_structured_result_reports_streams_sizes_and_timings(tmp_path, monkeypatch):
+    stub = tmp_path / "stub.sh"
+    stub.write_text('#!/bin/sh\necho "héllo"\necho "warn" >&2\nexit 3\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+
+    result = await server.run_cursor_tools([str(stub), "ask"], structured=True)
+
+    assert result["ok"] is False
+    assert result["exit_code"] == 3
+    assert result["stdout"] == "héllo"
+    assert result["stderr"] == "warn"
+    assert result["stdout_bytes"] == len("héllo\n".encode())
+    assert result["stderr_bytes"] == 5
+    assert result["duration_seconds"] >= result["time_to_first_byte_seconds"] >= 0
+    assert result["truncated"] is False
+    assert result["cache"] is None
+
+    # Text rendering is unchanged by default
+    text = await server.run_cursor_tools([str(stub), "ask"])
+    assert text == "Command failed with code 3:\nStdout:\nhéllo\nStderr:\nwarn"
+
+@pytest.mark.asyncio
+async def test_structured_result_records_truncation(tmp_path, monkeypatch):
+    stub = tmp_path / "stub.sh"
+    stub.write_text('#!/bin/sh\necho first\necho second\necho third\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+    monkeypatch.setattr(server, "MAX_OUTPUT_BYTES", 13)
+
+    result = await server.run_cursor_tools([str(stub), "ask"], structured=True)
+
+    assert result["stdout"] == "first\nsecond"
+    assert result["stdout_bytes"] == 19
+    assert result["truncated"] is True
+    assert result["truncated_bytes"] == 6
+
+@pytest.mark.asyncio
+async def test_truncation_keeps_no_lines_after_the_first_overflow(tmp_path, monkeypatch):
+    stub = tmp_path / "stub.sh"
+    stub.write_text('#!/bin/sh\necho first\necho a-much-longer-line\necho end\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+    monkeypatch.setattr(server, "MAX_OUTPUT_BYTES", 13)
+
+    result = await server.run_cursor_tools([str(stub), "ask"], structured=True)
+
+    # "end" would fit the budget but would leave a gap where the long line was
+    assert result["stdout"] == "first"
+    assert result["truncated_bytes"] == len("a-much-longer-line\nend\n")
+
+@pytest.mark.asyncio
+async def test_structured_result_reports_cache_status(counting_stub):
+    miss = await server.github_pr(number=1, structured=True)
+    hit = await server.github_pr(number=1, structured=True)
+
+    assert (miss["cache"], hit["cache"]) == ("miss", "hit")
+    assert hit["stdout"] == miss["stdout"]
+
+def test_duration_stats_key_includes_operation_and_provider():
+    assert server.duration_stats_key(["vt", "repo", "q", "--provider=gemini"]) == "repo|gemini"
+    assert server.duration_stats_key(["vt", "github", "pr", "12"]) == "github pr|default"
+    assert server.duration_stats_key(["vt", "ask", "github"]) == "ask|default"
+
+def test_duration_stats_ewma_and_quantiles():
+    stats = server.DurationStats()
+    for duration in [10, 10, 10, 10, 20]:
+        stats.record(duration, 1000)
+
+    assert stats.count == 5
+    assert stats.ewma_duration == pytest.approx(12.0)
+    assert stats.quantile(0.5) == 10
+    assert stats.quantile(1.0) == 20
+    assert stats.quantile(0.75) == 10
+
+def test_estimate_progress_uses_history_and_flags_stalls():
+    stats = server.DurationStats()
+    for _ in range(5):
+        stats.record(20, 4000)
+
+    # Without enough history the elapsed-time heuristic is kept
+    assert server.estimate_progress(server.DurationStats(), 30, 0).percent == 10
+
+    halfway = server.estimate_progress(stats, 10, 0)
+    assert halfway.percent == 50
+    assert halfway.eta_seconds == pytest.approx(10)
+    assert not halfway.stalled
+
+    # Output volume can pull the estimate forward
+    assert server.estimate_progress(stats, 2, 3000).percent == 75
+
+    late = server.estimate_progress(stats, 31, 0)
+    assert late.percent == 95
+    assert late.stalled
+
+@pytest.mark.asyncio
+async def test_successful_runs_update_persisted_duration_stats(tmp_path, monkeypatch):
+    stub = tmp_path / "stub.sh"
+    stub.write_text('#!/bin/sh\necho done\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+
+    await server.run_cursor_tools([str(stub), "plan", "q", "--provider=openai"])
+    await asyncio.sleep(0.1)
+    server.save_duration_stats()
+
+    monkeypatch.setattr(server, "_duration_stats", None)
+    stats = server.get_duration_stats()["plan|openai"]
+    assert stats.count == 1
+    assert stats.ewma_output_bytes == len(b"done\n")
+
+class _ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+@pytest.mark.asyncio
+async def test_child_stderr_logging_is_sampled(tmp_path, monkeypatch):
+    stub = tmp_path / "stub.sh"
+    stub.write_text('#!/bin/sh\ni=0\nwhile [ $i -lt 250 ]; do echo "line $i" >&2; i=$((i+1)); done\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+    handler = _ListHandler()
+    level = server.logger.level
+    server.logger.addHandler(handler)
+    try:
+        # Production default: nothing below WARNING is even formatted
+        await server.run_cursor_tools([str(stub), "ask"])
+        assert handler.messages == []
+
+        server.logger.setLevel(logging.DEBUG)
+        result = await server.run_cursor_tools([str(stub), "ask"], structured=True)
+    finally:
+        server.logger.setLevel(level)
+        server.logger.removeHandler(handler)
+
+    stderr_logs = [message for message in handler.messages if message.startswith("STDERR:")]
+    # First 20 lines, then lines 100 and 200
+    assert len(stderr_logs) == 22
+    assert stderr_logs[-1] == "STDERR: line 199"
+    assert any("22 of 250 stderr lines logged" in message for message in handler.messages)
+    # Sampling only affects logging, never the returned output
+    assert len(result["stderr"].splitlines()) == 250
+
+def test_semantic_cache_matches_rephrasings_within_partition():
+    cache = server.SemanticCache(max_entries=8, threshold=0.8, ttl=60)
+    partition = ("ask", "openai", "gpt-4", None, None)
+    answer = server.CommandResult(returncode=0, stdout="foo parses things")
+    cache.store(partition, "How does foo_parser handle a missing config file?", answer)
+
+    entry, similarity = cache.lookup(partition, "explain how foo_parser handles missing config files")
+    assert entry.result is answer
+    assert similarity == 1.0
+    # Small wording changes still clear the threshold
+    assert 0.8 <= cache.lookup(partition, "how is foo_parser handling missing config files")[1] < 1.0
+    # Different subject, or a different provider/model, never matches
+    assert cache.lookup(partition, "How does bar_loader handle a missing config file?") is None
+    assert cache.lookup(("ask", "anthropic", "claude-3", None, None), "How does foo_parser handle a missing config file?") is None
+
+def test_semantic_cache_requires_matching_numbers_and_negations():
+    cache = server.SemanticCache(max_entries=8, threshold=0.8, ttl=60)
+    partition = ("ask", "openai", "gpt-4", None, None)
+    cache.store(partition, "how do I configure pooling for the postgres driver in sqlalchemy version 1", server.CommandResult(returncode=0, stdout="v1"))
+    cache.store(partition, "is python list append thread safe", server.CommandResult(returncode=0, stdout="yes"))
+
+    # Trigram overlap alone scores both of these above the threshold
+    assert cache.lookup(partition, "how do I configure pooling for the postgres driver in sqlalchemy version 2") is None
+    assert cache.lookup(partition, "is python list append not thread safe") is None
+    assert cache.lookup(partition, "isn't python list append thread safe") is None
+    # Matching numbers and rephrasings around them still hit
+    assert cache.lookup(partition, "how should I configure pooling for the postgres driver in sqlalchemy version 1")[0].result.stdout == "v1"
+
+def test_semantic_cache_keeps_word_order_and_question_words():
+    cache = server.SemanticCache(max_entries=8, threshold=0.8, ttl=60)
+    partition = ("ask", "openai", "gpt-4", None, None)
+    for query in ["is pandas faster than polars", "convert json to yaml", "migrate from python2 to python3", "how do I install numpy"]:
+        cache.store(partition, query, server.CommandResult(returncode=0, stdout=query))
+
+    # The same words in another order, or another question word, ask something else
+    assert cache.lookup(partition, "is polars faster than pandas") is None
+    assert cache.lookup(partition, "convert yaml to json") is None
+    assert cache.lookup(partition, "migrate from python3 to python2") is None
+    assert cache.lookup(partition, "why would I install numpy") is None
+    # Same order and question word still hit
+    entry, similarity = cache.lookup(partition, "how can I install numpy")
+    assert entry.result.stdout == "how do I install numpy"
+    assert similarity == 1.0
+
+def test_semantic_cache_evicts_least_recently_used():
+    cache = server.SemanticCache(max_entries=2, threshold=0.8, ttl=60)
+    partition = ("web",)
+    for topic in ["alpha", "bravo"]:
+        cache.store(partition, f"what is {topic}", server.CommandResult(returncode=0, stdout=topic))
+    assert cache.lookup(partition, "explain alpha") is not None
+
+    cache.store(partition, "what is charlie", server.CommandResult(returncode=0, stdout="charlie"))
+
+    assert len(cache) == 2
+    assert cache.lookup(partition, "what is bravo") is None
+    assert cache.lookup(partition, "what is alpha") is not None
+    # Evicted entries leave no LSH buckets behind
+    assert all(cache._buckets.values())
+
+def test_semantic_cache_bounds_stored_bytes():
+    cache = server.SemanticCache(max_entries=8, threshold=0.8, ttl=60, max_bytes=100)
+    partition = ("web",)
+    cache.store(partition, "what is alpha", server.CommandResult(returncode=0, stdout="a" * 40))
+    cache.store(partition, "what is bravo", server.CommandResult(returncode=0, stdout="b" * 40))
+    cache.store(partition, "what is charlie", server.CommandResult(returncode=0, stdout="c" * 40))
+
+    # The oldest answer makes room, and one answer over the whole budget is not kept
+    assert cache.lookup(partition, "what is alpha") is None
+    assert cache.total_bytes == 80
+    cache.store(partition, "what is delta", server.CommandResult(returncode=0, stdout="d" * 101))
+    assert cache.lookup(partition, "what is delta") is None
+    assert len(cache) == 2
+
+@pytest.mark.asyncio
+async def test_ask_serves_rephrased_question_from_semantic_cache(counting_stub, monkeypatch):
+    monkeypatch.setattr(server, "semantic_cache_enabled", True)
+    monkeypatch.setattr(server, "_semantic_cache", server.SemanticCache())
+
+    first = await server.ask(query="What does build_command_args do?", provider="openai")
+    again = await server.ask(query="explain build_command_args", provider="openai", structured=True)
+    other_provider = await server.ask(query="explain build_command_args", provider="gemini")
+
+    assert "fetch 1" in first
+    assert again["cache"] == "hit"
+    assert "fetch 1" in again["stdout"]
+    assert "fetch 2" in other_provider
+    assert counting_stub() == 2
+
+def test_plan_browser_session_groups_steps():
+    invocations = server.plan_browser_session([
+        {"action": "act", "instruction": "click login"},
+        {"action": "act", "instruction": "type user"},
+        {"action": "evaluate", "instruction": "window.scrollTo(0, 0)"},
+        {"action": "observe", "instruction": "find buttons"},
+        {"action": "act", "instruction": "click submit"},
+        {"action": "extract", "instruction": "get the title"}
+    ])
+
+    assert [(i.action, i.instructions, i.steps, i.evaluate) for i in invocations] == [
+        ("act", ["click login", "type user"], [1, 2], None),
+        ("observe", ["find buttons"], [3, 4], "window.scrollTo(0, 0)"),
+        ("act", ["click submit"], [5], None),
+        ("extract", ["get the title"], [6], None)
+    ]
+
+    with pytest.raises(ValueError):
+        server.plan_browser_session([{"action": "act", "instruction": "x"}, {"action": "evaluate", "instruction": "1"}])
+    with pytest.raises(ValueError):
+        server.plan_browser_session([{"action": "click", "instruction": "x"}])
+
+@pytest.fixture
+def browser_stub(tmp_path, monkeypatch):
+    """Fake vibe-tools whose extract fails; returns a reader for the argv of each call."""
+    log = tmp_path / "calls.log"
+    stub = tmp_path / "stub.sh"
+    stub.write_text(f'#!/bin/sh\nfor arg in "$@"; do echo "$arg"; done >> {log}\necho "--" >> {log}\n'
+                    'case "$2" in extract) echo "bad page" >&2; exit 1 ;; esac\necho "did $2"\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+    monkeypatch.setattr(server, "cursor_tools_exec", str(stub))
+    return lambda: [call.strip().splitlines() for call in log.read_text().split("--\n") if call.strip()] if log.exists() else []
+
+SESSION_STEPS = [
+    {"action": "act", "instruction": "click login"},
+    {"action": "act", "instruction": "type user"},
+    {"action": "extract", "instruction": "get the title"},
+    {"action": "observe", "instruction": "find buttons"}
+]
+
+@pytest.mark.asyncio
+async def test_browser_session_reuses_page_and_stops_at_failure(browser_stub):
+    result = await server.browser_session(
+        steps=SESSION_STEPS, url="https://example.com", connect_to=9222, structured=True
+    )
+
+    calls = browser_stub()
+    assert len(calls) == 2
+    assert calls[0][:3] == ["browser", "act", "click login | type user"]
+    assert "--url=https://example.com" in calls[0]
+    assert calls[1][:2] == ["browser", "extract"]
+    assert "--url=current" in calls[1]
+    assert "--connect-to=9222" in calls[1]
+
+    assert result["ok"] is False
+    assert [step["steps"] for step in result["steps"]] == [[1, 2], [3]]
+    assert result["steps"][1]["stderr"] == "bad page"
+    assert result["skipped_steps"] == [4]
+
+@pytest.mark.asyncio
+async def test_browser_session_screenshots_every_step(browser_stub, tmp_path):
+    await server.browser_session(
+        steps=SESSION_STEPS, url="https://example.com", connect_to=9222, screenshot="shots/page.png"
+    )
+
+    calls = browser_stub()
+    assert [call[2] for call in calls] == ["click login", "type user", "get the title"]
+    for number, call in enumerate(calls, start=1):
+        assert f"--screenshot={tmp_path / 'shots' / f'page-step{number}.png'}" in call
+
+@pytest.mark.asyncio
+async def test_browser_session_needs_connect_to_for_several_invocations(browser_stub):
+    result = await server.browser_session(steps=SESSION_STEPS, url="https://example.com")
+
+    assert result.startswith("Error: these steps need 3 browser invocations")
+    # Structured callers get the same rejection as a failed result, not text
+    structured = await server.browser_session(steps=SESSION_STEPS, url="https://example.com", structured=True)
+    assert structured["ok"] is False
+    assert structured["error"].startswith("Error: these steps need 3 browser invocations")
+    invalid = await server.browser_session(steps=[{"action": "scroll", "instruction": "down"}], structured=True)
+    assert invalid["ok"] is False
+    assert browser_stub() == []
+
+    # A single invocation is fine without a shared browser
+    result = await server.browser_session(steps=SESSION_STEPS[:2], url="https://example.com")
+    assert "did act" in result
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not server.prlimit_supported, reason="child limits need prlimit")
+async def test_child_runs_under_configured_limits(tmp_path, monkeypatch):
+    stub = tmp_path / "stub.sh"
+    # Limits land just after exec, so give them a moment before reading them back
+    stub.write_text('#!/bin/sh\nsleep 0.2\nulimit -n\nulimit -t\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+    monkeypatch.setattr(server, "child_limits", server.ResourceLimits(max_cpu_seconds=30, max_open_files=64))
+
+    result = await server.run_cursor_tools([str(stub), "ask"], structured=True)
+
+    assert result["stdout"].splitlines() == ["64", "30"]
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not hasattr(os, "wait4"), reason="rusage needs wait4")
+async def test_child_usage_is_reported_and_aggregated(tmp_path, monkeypatch):
+    stub = tmp_path / "stub.sh"
+    stub.write_text('#!/bin/sh\necho done\n[ "$1" = fail ] && exit 1\nexit 0\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+    monkeypatch.setattr(server, "_command_metrics", {})
+
+    result = await server.run_cursor_tools([str(stub), "ask"], structured=True)
+    await server.run_cursor_tools([str(stub), "fail"], structured=True)
+
+    assert result["cpu_user_seconds"] >= 0
+    assert result["cpu_system_seconds"] >= 0
+    assert result["max_rss_kb"] > 0
+
+    metrics = await server.server_metrics()
+    assert metrics["commands"]["ask"]["calls"] == 1
+    assert metrics["commands"]["ask"]["failures"] == 0
+    assert metrics["commands"]["ask"]["max_rss_kb"] == result["max_rss_kb"]
+    assert metrics["commands"]["fail"]["failures"] == 1
+    assert metrics["scheduler"]["max_concurrency"] == server.max_concurrency
+    assert metrics["scheduler"]["running"] == 0
+
+def test_redact_argv_masks_secret_flags_and_key_shaped_values():
+    args = [
+        "ask", "what is sk-abcdefghijklmnopqrstuvwx for?", "--api-key", "plain-value",
+        "--github-token=abc", "--provider=openai", "--max-tokens=100",
+        "--authorization=Bearer abc", "--auth", "xyz", "--author=alice"
+    ]
+
+    assert server.redact_argv(args) == [
+        "ask", "what is [REDACTED] for?", "--api-key", "[REDACTED]",
+        "--github-token=[REDACTED]", "--provider=openai", "--max-tokens=100",
+        "--authorization=[REDACTED]", "--auth", "[REDACTED]", "--author=alice"
+    ]
+
+@pytest.mark.asyncio
+async def test_invocation_log_is_rotated_and_aggregated(tmp_path, monkeypatch):
+    stub = tmp_path / "stub.sh"
+    stub.write_text('#!/bin/sh\n[ "$1" = fail ] && exit 1\necho ok\n')
+    stub.chmod(0o755)
+    monkeypatch.setattr(server, "current_working_directory", str(tmp_path))
+    monkeypatch.setattr(server, "INVOCATION_LOG_MAX_BYTES", 1000)
+
+    for _ in range(4):
+        await server.run_cursor_tools([str(stub), "ask", "question", "--provider=openai"])
+    await server.run_cursor_tools([str(stub), "fail", "--provider=gemini"])
+    # Flush the writer thread
+    server._close_invocation_log()
+
+    assert len(server._invocation_log_files()) > 1
+    stats = await server.invocation_stats(top=2)
+    assert stats["invocations"] == 5
+    assert stats["tools"]["ask"]["calls"] == 4
+    assert stats["tools"]["ask"]["error_rate"] == 0
+    assert stats["tools"]["ask"]["p95"] >= stats["tools"]["ask"]["p50"] > 0
+    assert stats["providers"]["gemini"] == {"calls": 1, "errors": 1, "error_rate": 1.0}
+    assert len(stats["slowest"]) == 2
+    assert stats["slowest"][0]["duration"] >= stats["slowest"][1]["duration"]
+    assert stats["slowest"][0]["cwd"] == str(tmp_path)
+
+    only_fail = await server.invocation_stats(tool="fail")
+    assert only_fail["invocations"] == 1
+    assert only_fail["slowest"][0]["exit"] == 1
+
+@pytest.mark.asyncio
+async def test_invocation_log_records_cache_hits_and_rejected_calls(counting_stub, monkeypatch):
+    monkeypatch.setattr(server, "semantic_cache_enabled", True)
+    monkeypatch.setattr(server, "_semantic_cache", server.SemanticCache())
+
+    await server.ask(query="what is build_command_args", provider="openai")
+    await server.ask(query="explain build_command_args", provider="openai")
+    await server.github_pr(number=7)
+    await server.github_pr(number=7)
+    await server.ask(query="anything", priority="urgent")
+    monkeypatch.setattr(server, "cursor_tools_exec", "/nonexistent/vibe-tools")
+    await server.web(query="missing executable")
+    server._close_invocation_log()
+
+    records = [json.loads(line) for line in server.invocation_log_path().read_text().splitlines()]
+    # Two children ran, yet all six calls are logged
+    assert counting_stub() == 2
+    assert [(r["tool"], r.get("cache"), r["exit"]) for r in records] == [
+        ("ask", None, 0), ("ask", "hit", 0), ("github pr", None, 0), ("github pr", "hit", 0),
+        ("ask", None, None), ("web", None, None)
+    ]
+
+def test_invocation_log_touches_the_filesystem_only_when_opened():
+    result = server.CommandResult(returncode=0, stdout="ok")
+    server.record_invocation(["vibe-tools", "ask", "q"], "/cwd", result)
+
+    # Later records only queue a line for the writer thread
+    with patch("pathlib.Path.mkdir", side_effect=AssertionError("mkdir on the event loop")):
+        server.record_invocation(["vibe-tools", "ask", "q"], "/cwd", result)
+    server._close_invocation_log()
+
+    assert server.invocation_log_path().read_text().count('"tool":"ask"') == 2
+
+async def _grant_order(scheduler, lanes, delay=0.0):
+    """Queue one waiter per lane behind a held slot and return the order they start in."""
+    order = []
+    async def waiter(lane):
+        async with scheduler.slot(lane):
+            order.append(lane)
+    async with scheduler.slot("normal"):
+        tasks = []
+        for lane in lanes:
+            tasks.append(asyncio.create_task(waiter(lane)))
+            await asyncio.sleep(0)
+        await asyncio.sleep(delay)
+    await asyncio.gather(*tasks)
+    return order
+
+# Scheduler tests fail after this many seconds instead of hanging on a lost wake-up
+SCHEDULER_TEST_TIMEOUT = 5
+
+@pytest.mark.asyncio
+async def test_scheduler_starts_higher_lanes_first():
+    scheduler = server.PriorityScheduler(capacity=1, reserved=0, aging_seconds=0)
+
+    order = await asyncio.wait_for(
+        _grant_order(scheduler, ["bulk", "normal", "interactive", "bulk"]), SCHEDULER_TEST_TIMEOUT
+    )
+
+    assert order == ["interactive", "normal", "bulk", "bulk"]
+    stats = scheduler.to_dict()["lanes"]
+    assert stats["bulk"]["started"] == 2
+    assert stats["bulk"]["max_wait_seconds"] >= stats["interactive"]["max_wait_seconds"]
+    assert scheduler.running == 0
+
+@pytest.mark.asyncio
+async def test_scheduler_ages_waiting_bulk_work():
+    scheduler = server.PriorityScheduler(capacity=1, reserved=0, aging_seconds=0.05)
+    order = []
+
+    async def bulk():
+        async with scheduler.slot("bulk"):
+            order.append("bulk")
+
+    async def late_interactive():
+        await asyncio.sleep(0.15)
+        async with scheduler.slot("interactive"):
+            order.append("interactive")
+
+    async def scenario():
+        async with scheduler.slot("normal"):
+            tasks = [asyncio.create_task(bulk()), asyncio.create_task(late_interactive())]
+            await asyncio.sleep(0.2)
+        await asyncio.gather(*tasks)
+
+    await asyncio.wait_for(scenario(), SCHEDULER_TEST_TIMEOUT)
+
+    # The bulk call has waited long enough to rank with interactive, and arrived first
+    assert order == ["bulk", "interactive"]
+
+@pytest.mark.asyncio
+async def test_scheduler_reserves_slots_for_interactive_calls():
+    scheduler = server.PriorityScheduler(capacity=2, reserved=1, aging_seconds=0)
+
+    async def scenario():
+        async with scheduler.slot("bulk"):
+            second_bulk = asyncio.create_task(scheduler.slot("bulk").__aenter__())
+            await asyncio.sleep(0)
+            assert not second_bulk.done()
+            assert scheduler.lanes["bulk"].waiting == 1
+            # The reserved slot is still free for interactive work, though bulk is queued
+            async with scheduler.slot("interactive"):
+                assert scheduler.running == 2
+            second_bulk.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await second_bulk
+
+    await asyncio.wait_for(scenario(), SCHEDULER_TEST_TIMEOUT)
+
+    assert scheduler.running == 0
+    assert scheduler.lanes["bulk"].waiting == 0
+
+def test_default_lanes_per_command():
+    assert server.default_lane(["vt", "ask", "q"]) == "interactive"
+    assert server.default_lane(["vt", "github", "issue", "3"]) == "interactive"
+    assert server.default_lane(["vt", "repo", "q"]) == "normal"
+    assert server.default_lane(["vt", "repo", "q", "--from-github"]) == "bulk"
+    assert server.default_lane(["vt", "doc"]) == "bulk"
+
+@pytest.mark.asyncio
+async def test_unknown_priority_is_rejected_without_spawning():
+    result = await server.run_cursor_tools(["cursor-tools", "ask", "q"], priority="urgent")
+
+    assert result.startswith("Error: unknown priority 'urgent'")